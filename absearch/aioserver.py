@@ -0,0 +1,335 @@
+"""An asyncio HTTP/1.1 front end serving the routes of absearch.server.
+
+Requests are answered from the event loop thread, using the same
+SearchSettings as the Bottle app. Connections are kept alive, can
+pipeline requests, and their number is bounded.
+
+    absearch-aioserver config/absearch.ini
+"""
+import asyncio
+import datetime
+import json
+import os
+import sys
+import time
+from email.utils import formatdate
+from urllib.parse import parse_qsl, unquote
+
+from absearch import logger, server
+
+
+MAX_HEADERS_SIZE = 8192
+MAX_BODY_SIZE = 8192
+
+_REASONS = {
+    200: 'OK',
+    304: 'Not Modified',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    431: 'Request Header Fields Too Large',
+    500: 'Internal Server Error',
+}
+
+# the routes answering a JSON document, as the Bottle app does
+_PAGES = {
+    '/': server.root,
+    '/__lbheartbeat__': server.lhb,
+    '/__heartbeat__': server.hb,
+    '/__stats__': server.stats,
+    '/__info__': server.info,
+    '/__version__': server.version,
+}
+
+
+class BadRequest(Exception):
+    pass
+
+
+class HTTPProtocol(asyncio.Protocol):
+    """One client connection."""
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.last_seen = 0
+        self._buffer = bytearray()
+        self._paused = False
+        # the request whose body is being received, and its size left
+        self._request = None
+        self._body_left = 0
+
+    def connection_made(self, transport):
+        if len(self.server.connections) >= self.server.max_connections:
+            self.server.metrics.incr('aioserver.rejected')
+            transport.close()
+            return
+        self.transport = transport
+        self.last_seen = self.server.loop.time()
+        self.server.connections.add(self)
+
+    def connection_lost(self, exc):
+        self.server.connections.discard(self)
+        self.transport = None
+
+    def pause_writing(self):
+        # the client does not read its responses, let's not read its
+        # requests either
+        self._paused = True
+        if self.transport is not None:
+            self.transport.pause_reading()
+
+    def resume_writing(self):
+        self._paused = False
+        if self.transport is not None:
+            self.transport.resume_reading()
+            self._process()
+
+    def data_received(self, data):
+        self.last_seen = self.server.loop.time()
+        self._buffer += data
+        self._process()
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    def _process(self):
+        # answers every complete request of the buffer, in order
+        while self.transport is not None and not self._paused:
+            if self._request is None:
+                end = self._buffer.find(b'\r\n\r\n')
+                if end == -1:
+                    if len(self._buffer) > MAX_HEADERS_SIZE:
+                        self._fail(431)
+                    return
+                if end > MAX_HEADERS_SIZE:
+                    self._fail(431)
+                    return
+
+                try:
+                    request = self._parse(bytes(self._buffer[:end]))
+                    length = int(request[3].get('content-length', 0))
+                    if length < 0 or 'transfer-encoding' in request[3]:
+                        raise BadRequest()
+                except (BadRequest, ValueError):
+                    self._fail(400)
+                    return
+                if length > MAX_BODY_SIZE:
+                    # no route takes a body
+                    self._fail(413)
+                    return
+                del self._buffer[:end + 4]
+                self._request = request
+                self._body_left = length
+
+            if self._body_left:
+                # the body is ignored, and dropped as it comes
+                dropped = min(self._body_left, len(self._buffer))
+                del self._buffer[:dropped]
+                self._body_left -= dropped
+                if self._body_left:
+                    return
+
+            method, target, version, headers = self._request
+            self._request = None
+
+            connection = headers.get('connection', '').lower()
+            if version == 'HTTP/1.1':
+                keep_alive = connection != 'close'
+            else:
+                keep_alive = connection == 'keep-alive'
+
+            status, extra, body = self.server.handle(method, target,
+                                                     headers)
+            self._send(status, extra, body, version, keep_alive,
+                       method == 'HEAD')
+            if not keep_alive:
+                self.close()
+
+    def _parse(self, head):
+        lines = head.decode('latin-1').split('\r\n')
+        parts = lines[0].split(' ')
+        if len(parts) != 3 or not parts[2].startswith('HTTP/1.'):
+            raise BadRequest()
+        method, target, version = parts
+
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if not sep:
+                raise BadRequest()
+            headers[name.strip().lower()] = value.strip()
+        return method, target, version, headers
+
+    def _send(self, status, headers, body, version, keep_alive,
+              head=False):
+        lines = ['%s %d %s' % (version, status, _REASONS[status]),
+                 'Date: %s' % self.server.date(),
+                 'Content-Length: %d' % len(body)]
+        if not keep_alive:
+            lines.append('Connection: close')
+        elif version == 'HTTP/1.0':
+            lines.append('Connection: keep-alive')
+        lines.extend('%s: %s' % header for header in headers)
+        lines.append('\r\n')
+
+        data = '\r\n'.join(lines).encode('latin-1')
+        self.transport.write(data if head else data + body)
+
+    def _fail(self, status):
+        self._send(status, self.server.common_headers, b'', 'HTTP/1.1',
+                   False)
+        self.close()
+
+
+class AsyncServer(object):
+    """Answers the requests of HTTPProtocol connections.
+
+    Connections idle for more than keepalive_timeout seconds are closed,
+    and the ones beyond max_connections are refused.
+    """
+
+    def __init__(self, settings, max_connections=10000,
+                 keepalive_timeout=75., loop=None):
+        self.settings = settings
+        self.metrics = settings.metrics
+        self.max_connections = int(max_connections)
+        self.keepalive_timeout = float(keepalive_timeout)
+        self.loop = loop
+        self.connections = set()
+        self.common_headers = server.COMMON_HEADERS
+        self._json_headers = server.JSON_HEADERS
+        self._server = None
+        self._sweeper = None
+        self._date = None
+        self._date_second = None
+
+    def date(self):
+        # formatted once per second
+        now = int(self.loop.time())
+        if now != self._date_second:
+            self._date = formatdate(usegmt=True)
+            self._date_second = now
+        return self._date
+
+    async def start(self, host='0.0.0.0', port=8080, **kw):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        self._server = await self.loop.create_server(
+            lambda: HTTPProtocol(self), host, port, **kw)
+        self._sweeper = self.loop.create_task(self._sweep())
+        return self._server
+
+    async def _sweep(self):
+        # one timer for all the connections
+        while True:
+            await asyncio.sleep(min(self.keepalive_timeout, 1.))
+            deadline = self.loop.time() - self.keepalive_timeout
+            for connection in list(self.connections):
+                if connection.last_seen < deadline:
+                    connection.close()
+
+    def close(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+        if self._server is not None:
+            self._server.close()
+        for connection in list(self.connections):
+            connection.close()
+
+    def handle(self, method, target, headers):
+        """Returns the status, headers and body answering a request."""
+        started = time.perf_counter()
+        path, _, query = target.partition('?')
+        try:
+            status, extra, body = self._dispatch(method, path, headers)
+        except Exception:
+            server.handle_500_error(500)
+            status, extra, body = 500, self.common_headers, b''
+
+        self._log(method, path, query, headers, status, started)
+        return status, extra, body
+
+    def _dispatch(self, method, path, headers):
+        if method not in ('GET', 'HEAD'):
+            return 405, self.common_headers, b''
+
+        page = _PAGES.get(path)
+        if page is not None:
+            body = json.dumps(page()).encode('utf8')
+            return 200, self._json_headers, body
+
+        segments = path.split('/')
+        # /1/<prod>/<ver>/<channel>/<locale>/<territory>/<dist>/<distver>
+        # and /<cohort>
+        if (len(segments) not in (9, 10) or segments[1] != '1' or
+                not all(segments[2:])):
+            return 404, self._json_headers, b''
+
+        return server.answer(self.settings,
+                             [unquote(segment) for segment in segments[2:]],
+                             headers.get('if-none-match'),
+                             headers.get('accept-encoding'))
+
+    def _log(self, method, path, query, headers, status, started):
+        context = dict(
+            agent=headers.get('user-agent'),
+            path=path,
+            method=method,
+            lang=headers.get('accept-language'),
+            code=status,
+            time=datetime.datetime.now().isoformat(),
+            t=(time.perf_counter() - started) * 1000,  # msec
+        )
+        if query:
+            context['qs'] = dict(parse_qsl(query))
+        server.summary_logger.info('', extra=context)
+
+
+def _use_uvloop():
+    try:
+        import uvloop
+    except ImportError:
+        logger.warning('uvloop is not installed, using asyncio')
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
+async def serve(settings, host, port, max_connections=10000,
+                keepalive_timeout=75.):
+    # the event loop must never wait for the files to be reloaded
+    settings.reload_in_background()
+    front = AsyncServer(settings, max_connections, keepalive_timeout)
+    listener = await front.start(host, port)
+    try:
+        await listener.serve_forever()
+    finally:
+        front.close()
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    if len(args) > 0:
+        config = args[0]
+    else:
+        config = os.path.join(os.path.dirname(__file__), '..', 'config',
+                              'absearch.ini')
+
+    server.initialize_app(config)
+    abconf = server.app._config['absearch']
+    if abconf.get('event_loop', 'asyncio') == 'uvloop':
+        _use_uvloop()
+
+    logger.info('Serving on %s:%s' % (abconf['host'], abconf['port']))
+    try:
+        asyncio.run(serve(server.app.settings, abconf['host'],
+                          abconf['port'],
+                          abconf.get('max_connections', 10000),
+                          abconf.get('keepalive_timeout', 75)))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,53 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """A bounded mapping dropping the least recently used items.
+
+    Hits, misses and evictions are counted in metrics, as <name>.hits,
+    <name>.misses and <name>.evictions. A size of 0 disables it.
+    """
+
+    def __init__(self, size, metrics=None, name='cache'):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._metrics = metrics
+        self._names = dict((event, '%s.%s' % (name, event))
+                           for event in ('hits', 'misses', 'evictions'))
+
+    def __len__(self):
+        return len(self._items)
+
+    def _count(self, event, count=1):
+        if self._metrics is not None:
+            self._metrics.incr(self._names[event], count)
+
+    def get(self, key, default=None):
+        if not self.size:
+            return default
+        with self._lock:
+            try:
+                value = self._items[key]
+            except KeyError:
+                value = default
+                event = 'misses'
+            else:
+                self._items.move_to_end(key)
+                event = 'hits'
+        self._count(event)
+        return value
+
+    def put(self, key, value):
+        if not self.size:
+            return
+        evicted = 0
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+                evicted += 1
+        if evicted:
+            self._count('evictions', evicted)
@@ -1,13 +1,14 @@
 import sys
 import os
-import json
 import argparse
-import hashlib
+import json
 
+from absearch.readers import FileReader
 from absearch.settings import SearchSettings
 
 
 DEFAULT_DATADIR = os.path.join(os.path.dirname(__file__), '..', 'data')
+REQUEST = 'PROD/VER/CHANNEL/LOCALE/TERRITORY/DIST/DISTVER[/COHORT]'
 
 
 def main(args=sys.argv[1:]):
@@ -18,6 +19,9 @@ def main(args=sys.argv[1:]):
                         type=str, default='config.json')
     parser.add_argument('-s', '--schema-file', help='Schema File',
                         type=str, default='config.schema.json')
+    parser.add_argument('-e', '--explain', type=str, default=None,
+                        metavar=REQUEST,
+                        help='Explains how a request is resolved')
 
     args = parser.parse_args(args=args)
 
@@ -25,28 +29,21 @@ def main(args=sys.argv[1:]):
     configpath = os.path.join(args.data_dir, args.config_file)
     schemapath = os.path.join(args.data_dir, args.schema_file)
 
-    def read_config():
-        with open(configpath) as f:
-            data = f.read()
-            return (
-                json.loads(data),
-                hashlib.md5(data.encode("utf8")).hexdigest(),
-            )
-
-    def read_schema():
-        with open(schemapath) as f:
-            data = f.read()
-            return (
-                json.loads(data),
-                hashlib.md5(data.encode("utf8")).hexdigest(),
-            )
-
     try:
-        SearchSettings(read_config, read_schema)
+        settings = SearchSettings(FileReader(configpath),
+                                  FileReader(schemapath))
     except ValueError as e:
         print('Not a valid JSON file')
         print(str(e))
         return 1
 
     print('OK')
+
+    if args.explain is not None:
+        request = args.explain.strip('/').split('/')
+        if len(request) not in (7, 8):
+            print('The request should be %s' % REQUEST)
+            return 1
+        explanation = settings.explain(*request)
+        print(json.dumps(explanation, indent=2, sort_keys=True))
     return 0
@@ -1,19 +1,590 @@
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+from array import array
 from collections import defaultdict
 
+from absearch import logger
 
-class MemoryCohortCounters(object):
 
-    def __init__(self, **kw):
-        self._counters = defaultdict(int)
+_SLOT = struct.Struct('q')
 
-    def _key(self, *args):
-        return ':'.join(args)
+# the shared files start with the digest of the file they come from
+_HEADER_SIZE = 16
+
+_NEVER = float('inf')
+
+
+class Layout(object):
+    """Where the counters are: keys[slot] is counted in values[slot].
+
+    limits[slot] is the capacity of the cohort, or 0.
+    """
+
+    def __init__(self, keys, values, file=None):
+        self.keys = keys
+        self.slots = dict((key, slot) for slot, key in enumerate(keys))
+        self.values = values
+        self.limits = [0] * len(keys)
+        self.file = file
+
+
+class Window(object):
+    """A rolling sum over the last minutes, kept in a ring of per-minute
+    buckets.
+    """
+
+    __slots__ = ('minutes', 'buckets', 'minute', 'total', 'lock')
+
+    def __init__(self, minutes):
+        self.minutes = minutes
+        self.buckets = array('q', [0]) * minutes
+        self.minute = 0
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def advance(self, minute):
+        """Drops the buckets older than the window, and returns the sum."""
+        elapsed = minute - self.minute
+        if elapsed <= 0:
+            return self.total
+        if elapsed >= self.minutes:
+            if self.total:
+                self.buckets = array('q', [0]) * self.minutes
+                self.total = 0
+        else:
+            for past in range(self.minute + 1, minute + 1):
+                bucket = past % self.minutes
+                self.total -= self.buckets[bucket]
+                self.buckets[bucket] = 0
+        self.minute = minute
+        return self.total
+
+    def add(self, minute, value):
+        self.advance(minute)
+        self.buckets[self.minute % self.minutes] += value
+        self.total += value
+        return self.total
+
+
+class CohortCounters(object):
+    """Base class of the counter backends.
+
+    Every (locale, territory, cohort) key of the config gets an integer
+    slot with set_slots(), so counting it does not build or hash any
+    key. Keys without a slot are counted in a dict. Updates are spread
+    over a fixed number of locks, so threads updating different cohorts
+    rarely wait for each other.
+
+    The listener given to set_capacities() is told when a cohort
+    reaches its capacity, and when it goes back under it.
+
+    A capacity can be per window of minutes: the cohort is then full
+    while its enrollments of the last minutes reach the capacity.
+    Windows are counted by each process. expire() must be called once
+    the clock reaches next_expiry, so the full windowed cohorts are
+    told when their old enrollments expire.
+    """
+
+    def __init__(self, stripes=64, clock=time.time):
+        self._locks = [threading.Lock() for i in range(stripes)]
+        self._layout = self._allocate([], None)
+        self._others = defaultdict(int)
+        self._capacities = {}
+        self._windows = {}
+        self._full = set()
+        self._listener = None
+        self._clock = clock
+        self.version = None
+        self.next_expiry = _NEVER
+
+    def _allocate(self, keys, previous):
+        """Returns the Layout of some keys, carrying the values of the
+        previous one.
+        """
+        layout = Layout(keys, array('q', bytes(_SLOT.size * len(keys))))
+        if previous is not None:
+            self._carry(previous, layout)
+        return layout
+
+    def _carry(self, previous, layout):
+        for slot, key in enumerate(layout.keys):
+            if key in previous.slots:
+                layout.values[slot] = previous.values[previous.slots[key]]
+            elif key in self._others:
+                layout.values[slot] = self._others.pop(key)
+
+    def _update(self, layout, slot, value):
+        # called with the lock of the slot held
+        layout.values[slot] += value
+        return layout.values[slot]
+
+    def set_slots(self, keys, version=None):
+        """Lays out the counters of every (locale, territory, cohort)
+        key of the config. Values are kept for the keys that still exist.
+
+        version identifies the config, usually its md5.
+        """
+        self.version = version
+        keys = list(keys)
+        if keys == self._layout.keys:
+            # same cohorts, same slots
+            return
+        # updates wait until the values are carried over
+        for lock in self._locks:
+            lock.acquire()
+        try:
+            layout = self._allocate(keys, self._layout)
+            for key, size in self._capacities.items():
+                if key in layout.slots:
+                    layout.limits[layout.slots[key]] = size
+            self._layout = layout
+        finally:
+            for lock in self._locks:
+                lock.release()
+
+    def slot(self, locale, territory, cohort):
+        """Returns the slot of a key, or None."""
+        return self._layout.slots.get((locale, territory, cohort))
+
+    def set_capacities(self, capacities, listener=None, windows=None):
+        """Sets the capacity of some cohorts.
+
+        capacities maps (locale, territory, cohort) keys to a maxSize,
+        and windows some of these keys to a number of minutes.
+        listener(locale, territory, cohort, full) is called when a
+        cohort becomes full or stops being full.
+
+        Returns the keys of the cohorts that are already full.
+        """
+        self._listener = listener
+        self._capacities = dict(capacities)
+
+        # the windows that still have the same length are kept
+        previous = self._windows
+        self._windows = {}
+        for key, minutes in (windows or {}).items():
+            window = previous.get(key)
+            if window is None or window.minutes != minutes:
+                window = Window(minutes)
+            self._windows[key] = window
+
+        layout = self._layout
+        limits = [0] * len(layout.keys)
+        for key, size in self._capacities.items():
+            if key in layout.slots:
+                limits[layout.slots[key]] = size
+        layout.limits = limits
+
+        minute = self._minute()
+        self._full = set(key for key, size in self._capacities.items()
+                         if self._level(key, minute) >= size)
+        self._schedule(minute)
+        return set(self._full)
+
+    def _minute(self):
+        return int(self._clock() // 60)
+
+    def _level(self, key, minute):
+        window = self._windows.get(key)
+        if window is None:
+            return self.get(*key)
+        with window.lock:
+            return window.advance(minute)
+
+    def _schedule(self, minute):
+        # a full window may drop below its capacity at the next minute
+        if any(key in self._windows for key in list(self._full)):
+            self.next_expiry = (minute + 1) * 60
+        else:
+            self.next_expiry = _NEVER
+
+    def expire(self):
+        """Drops the enrollments that left their window, and tells the
+        listener about the cohorts that are not full anymore.
+        """
+        minute = self._minute()
+        for key in list(self._full):
+            window = self._windows.get(key)
+            if window is not None:
+                with window.lock:
+                    self._changed(key, window.advance(minute))
+        self._schedule(minute)
+
+    def saturated(self):
+        """Returns the keys of the cohorts that reached their capacity."""
+        return sorted(self._full)
+
+    def _changed(self, key, value):
+        size = self._capacities.get(key)
+        if size is None:
+            return
+
+        full = value >= size
+        if full == (key in self._full):
+            return
+        if full:
+            self._full.add(key)
+        else:
+            self._full.discard(key)
+
+        if self._listener is not None:
+            self._listener(key[0], key[1], key[2], full)
+
+    def _check(self, key, value, current):
+        # called after an update of a cohort that has a capacity
+        window = self._windows.get(key)
+        if window is None:
+            self._changed(key, current)
+            return
+
+        minute = self._minute()
+        with window.lock:
+            self._changed(key, window.add(minute, value))
+        if key in self._full and self.next_expiry == _NEVER:
+            self.next_expiry = (minute + 1) * 60
+
+    def _add(self, key, value, slot=None):
+        while True:
+            if slot is None:
+                slot = self._layout.slots.get(key)
+
+            if slot is None:
+                with self._locks[hash(key) % len(self._locks)]:
+                    self._others[key] += value
+                    self._check(key, value, self._others[key])
+                return
+
+            with self._locks[slot % len(self._locks)]:
+                layout = self._layout
+                if slot < len(layout.keys) and layout.keys[slot] == key:
+                    current = self._update(layout, slot, value)
+                    # the capacity is checked under the same lock, so the
+                    # events of a cohort come in order
+                    if layout.limits[slot]:
+                        self._check(key, value, current)
+                    return
+
+            # the slots were laid out again meanwhile
+            slot = None
 
     def incr(self, locale, territory, cohort):
-        self._counters[self._key(locale, territory, cohort)] += 1
+        self._add((locale, territory, cohort), 1)
+
+    def incr_slot(self, slot, key):
+        """Increments the counter of a key, using its slot."""
+        self._add(key, 1, slot)
 
     def get(self, locale, territory, cohort):
-        return self._counters[self._key(locale, territory, cohort)]
+        key = locale, territory, cohort
+        layout = self._layout
+        slot = layout.slots.get(key)
+        if slot is None:
+            return self._others.get(key, 0)
+        return layout.values[slot]
 
     def decr(self, locale, territory, cohort):
-        self._counters[self._key(locale, territory, cohort)] -= 1
+        self._add((locale, territory, cohort), -1)
+
+    def close(self):
+        """Releases what the backend uses."""
+
+    def before_fork(self):
+        """Stops the threads of the backend, before the process forks."""
+
+    def after_fork(self, worker=0):
+        """Prepares the backend in a forked worker process."""
+
+    def worker_exited(self):
+        """Collects what a worker forked before the last set_slots
+        counted, once it exited.
+        """
+
+
+class MemoryCohortCounters(CohortCounters):
+    """Counters kept in memory, safe to use from several threads.
+
+    With a checkpoint path, a background thread writes the counters to
+    that file every checkpoint_interval seconds, and they're read back
+    when the process starts, for the cohorts that still exist, so a
+    restart does not reopen the capped cohorts, even with a new config.
+    The file is replaced atomically: a crash leaves the previous
+    checkpoint. Each process needs its own path.
+
+    Forked workers checkpoint to the path suffixed with their number,
+    or to a temporary one without a path, so the worker replacing one
+    goes on with its counters.
+    """
+
+    def __init__(self, stripes=64, checkpoint=None, checkpoint_interval=10.,
+                 clock=time.time, **kw):
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = float(checkpoint_interval)
+        self._restored = False
+        self._saved = None
+        self._save_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._writer = None
+        self._handoff = None
+        super(MemoryCohortCounters, self).__init__(stripes, clock)
+        self._start()
+
+    def _start(self):
+        if self.checkpoint and self.checkpoint_interval > 0:
+            self._stopped = threading.Event()
+            self._writer = threading.Thread(target=self._save_loop,
+                                            name='absearch-checkpoint')
+            self._writer.daemon = True
+            self._writer.start()
+
+    def _stop(self):
+        self._stopped.set()
+        if self._writer is not None:
+            self._writer.join()
+            self._writer = None
+
+    def set_slots(self, keys, version=None):
+        super(MemoryCohortCounters, self).set_slots(keys, version)
+        if self.checkpoint and not self._restored:
+            self._restored = True
+            self.restore()
+
+    def restore(self):
+        """Adds the checkpointed counters of the cohorts that are still
+        in the config, whatever its version.
+
+        Returns the number of restored counters.
+        """
+        try:
+            with open(self.checkpoint) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return 0
+        except ValueError:
+            logger.warning('Ignoring the invalid checkpoint %r' %
+                           self.checkpoint)
+            return 0
+
+        restored = 0
+        layout = self._layout
+        for locale, territory, cohort, value in data['counters']:
+            key = locale, territory, cohort
+            slot = layout.slots.get(key)
+            if slot is not None:
+                self._add(key, value, slot)
+                restored += 1
+        logger.info('Restored %d counters from %r' % (restored,
+                                                      self.checkpoint))
+        return restored
+
+    def _save_loop(self):
+        while not self._stopped.wait(self.checkpoint_interval):
+            try:
+                self.save()
+            except Exception:
+                logger.exception('Could not checkpoint the counters')
+
+    def save(self):
+        """Writes the counters to the checkpoint, if they changed since
+        the last call.
+
+        Returns True if the checkpoint was written.
+        """
+        with self._save_lock:
+            layout = self._layout
+            # a copy of the values, taken without blocking the updates
+            state = self.version, layout.keys, layout.values.tobytes()
+            if state == self._saved:
+                return False
+
+            values = array('q', state[2])
+            counters = [list(key) + [values[slot]]
+                        for slot, key in enumerate(layout.keys)
+                        if values[slot]]
+            data = json.dumps({'version': self.version,
+                               'counters': counters})
+
+            temp = '%s.%d.tmp' % (self.checkpoint, os.getpid())
+            with open(temp, 'w') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp, self.checkpoint)
+            self._saved = state
+            return True
+
+    def close(self):
+        self._stop()
+        if self.checkpoint:
+            self.save()
+        if self._handoff is not None:
+            shutil.rmtree(self._handoff, ignore_errors=True)
+            self._handoff = None
+
+    def before_fork(self):
+        self._stop()
+        if not self.checkpoint:
+            # the workers hand their counters over to the next worker
+            # with their number through a checkpoint, which lives as
+            # long as this process
+            self._handoff = tempfile.mkdtemp(prefix='absearch-counters-')
+            self.checkpoint = os.path.join(self._handoff, 'counters.json')
+
+    def after_fork(self, worker=0):
+        # every worker counts on its own, and has its own checkpoint,
+        # read back by the workers replacing it
+        self._handoff = None
+        layout = self._layout
+        for slot in range(len(layout.keys)):
+            layout.values[slot] = 0
+        self._others.clear()
+        self.checkpoint = '%s.%d' % (self.checkpoint, worker)
+        self._saved = None
+        self.restore()
+        self._start()
+
+
+class SharedCohortCounters(CohortCounters):
+    """Counters shared by the processes of a host.
+
+    The slots live in a memory-mapped file. They are sorted, so all the
+    processes loading the same config agree on them. An update locks
+    its slot with fcntl across processes, and with a thread lock within
+    one.
+
+    A new set of slots lives in a new file, which starts with the values
+    of the cohorts that still exist. The processes that switch to it
+    later add what was counted meanwhile in the file they come from,
+    since they are the only ones seeing it once it's removed. The
+    workers forked before the switch never make it: the process that
+    forked them adds what they counted as they exit. Keys
+    without a slot are counted in memory, for this process only.
+
+    The files are named after path, which must be in a directory only
+    the service can write to. Without a path, a private temporary
+    directory is used: only the processes forked from this one share
+    it.
+    """
+
+    def __init__(self, path=None, stripes=64, clock=time.time, **kw):
+        # a private directory, shared by the processes forked from here
+        self._directory = None
+        if path is None:
+            self._directory = tempfile.mkdtemp(prefix='absearch-counters-')
+            path = os.path.join(self._directory, 'counters')
+        self.path = path
+        self._owner = os.getpid()
+        self._filename = None
+        self._digest = None
+        # the layout we switched from, and what was carried from it
+        self._previous = None
+        self._carried = None
+        super(SharedCohortCounters, self).__init__(stripes, clock)
+
+    def close(self):
+        if self._directory is not None and os.getpid() == self._owner:
+            shutil.rmtree(self._directory, ignore_errors=True)
+            self._directory = None
+
+    def _allocate(self, keys, previous):
+        if previous is None:
+            # nothing is shared before we know the slots
+            return super(SharedCohortCounters, self)._allocate(keys, None)
+
+        layout = '\n'.join(':'.join(key) for key in keys)
+        digest = hashlib.md5(layout.encode('utf8')).hexdigest()[:16]
+        filename = '%s.%s' % (self.path, digest)
+        if filename == self._filename:
+            return previous
+
+        # the file from which the values were carried, the values, and
+        # the values of that file that were carried
+        length = len(keys) * _SLOT.size
+        size = _HEADER_SIZE + 2 * length
+        # never following a link someone else put there
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW,
+                     0o600)
+        file_ = os.fdopen(fd, 'r+b')
+        try:
+            fcntl.lockf(file_, fcntl.LOCK_EX)
+            try:
+                created = os.fstat(file_.fileno()).st_size < size
+                if created:
+                    file_.truncate(size)
+                mapped = memoryview(mmap.mmap(file_.fileno(), size))
+                values = mapped[_HEADER_SIZE:_HEADER_SIZE + length]
+                carried = mapped[_HEADER_SIZE + length:
+                                 _HEADER_SIZE + 2 * length].cast('q')
+                layout = Layout(keys, values.cast('q'), file_)
+                source = (self._digest or '').encode('ascii')
+                if created:
+                    # the first process using these slots brings the
+                    # values it knows
+                    mapped[:len(source)] = source
+                    self._carry(previous, layout)
+                    for slot, key in enumerate(keys):
+                        if key in previous.slots:
+                            carried[slot] = layout.values[slot]
+                elif source and bytes(mapped[:_HEADER_SIZE]) == source:
+                    # the other processes kept counting in the file we
+                    # come from since it was carried
+                    self._catch_up(previous, layout, carried)
+            finally:
+                fcntl.lockf(file_, fcntl.LOCK_UN)
+        except Exception:
+            file_.close()
+            raise
+
+        old, self._filename = self._filename, filename
+        self._digest = digest
+        if previous.file is not None:
+            # the workers forked before keep counting in it
+            self._previous, self._carried = previous, carried
+        if old is not None:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+        return layout
+
+    def worker_exited(self):
+        previous, layout = self._previous, self._layout
+        if previous is None:
+            return
+        for lock in self._locks:
+            lock.acquire()
+        try:
+            fcntl.lockf(layout.file, fcntl.LOCK_EX)
+            try:
+                self._catch_up(previous, layout, self._carried)
+            finally:
+                fcntl.lockf(layout.file, fcntl.LOCK_UN)
+        finally:
+            for lock in self._locks:
+                lock.release()
+
+    def _catch_up(self, previous, layout, carried):
+        # called with the file locked
+        for slot, key in enumerate(layout.keys):
+            old_slot = previous.slots.get(key)
+            if old_slot is None:
+                continue
+            value = previous.values[old_slot]
+            layout.values[slot] += value - carried[slot]
+            carried[slot] = value
+
+    def _update(self, layout, slot, value):
+        offset = _HEADER_SIZE + slot * _SLOT.size
+        fcntl.lockf(layout.file, fcntl.LOCK_EX, _SLOT.size, offset)
+        try:
+            layout.values[slot] += value
+            return layout.values[slot]
+        finally:
+            fcntl.lockf(layout.file, fcntl.LOCK_UN, _SLOT.size, offset)
@@ -0,0 +1,399 @@
+"""Lookup structures compiled by SearchSettings.load().
+
+Filters are interpreted once per config load so a request only needs
+a couple of dict lookups and a bisect to find its eligible cohorts.
+"""
+import bisect
+import operator
+import random
+import re
+import threading
+import time
+from functools import lru_cache
+
+from absearch.responses import build_response
+
+
+# Use a very small version
+MIN_VERSION = '0.1'
+# Use a very large version
+MAX_VERSION = '1000.0'
+
+_VERSION_COMPONENT = re.compile(r'(\d+ | [a-z]+ | \.)', re.VERBOSE)
+
+
+@lru_cache(maxsize=1024)
+def parse_version(vstring):
+    """Parses a version the way distutils' LooseVersion does.
+
+    Components are tagged so numbers sort before strings, like they
+    did under Python 2, which keeps any two versions comparable.
+    """
+    parts = []
+    for part in _VERSION_COMPONENT.split(vstring):
+        if not part or part == '.':
+            continue
+        try:
+            parts.append((0, int(part)))
+        except ValueError:
+            parts.append((1, part))
+    return tuple(parts)
+
+
+def accumulate(iterable):
+    it = iter(iterable)
+    try:
+        total = next(it)
+    except StopIteration:
+        return
+    yield total
+    for element in it:
+        total = operator.add(total, element)
+        yield total
+
+
+# marks the end of a prefix in a trie node
+_END = None
+
+
+class PrefixMatcher(object):
+    """Tells if a string starts with one of some prefixes.
+
+    The prefixes are compiled into a trie, so matching a string costs at
+    most one dict lookup per character whatever the number of prefixes.
+    Answers are memoized, the memo being emptied when it's full.
+    """
+
+    def __init__(self, prefixes, memo_size=1024):
+        self._root = {}
+        for prefix in prefixes:
+            node = self._root
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node[_END] = True
+        self._memo = {}
+        self._memo_size = memo_size
+
+    def _match(self, value):
+        node = self._root
+        if _END in node:
+            return True
+        for char in value:
+            node = node.get(char)
+            if node is None:
+                return False
+            if _END in node:
+                return True
+        return False
+
+    def matches(self, value):
+        try:
+            return self._memo[value]
+        except KeyError:
+            pass
+
+        res = self._match(value)
+        if len(self._memo) >= self._memo_size:
+            self._memo.clear()
+        self._memo[value] = res
+        return res
+
+
+class CompiledTest(object):
+    """A test and its filters, converted to comparable values."""
+
+    __slots__ = ('name', 'data', 'response', 'sample_rate', 'products',
+                 'channels', 'min_version', 'max_version', 'start_time',
+                 'max_size', 'window', 'key', 'slot')
+
+    def __init__(self, name, data, interval, etag_seed='', lower=str.lower):
+        filters = data['filters']
+        self.name = name
+        self.data = data
+        self.response = build_response(data, interval, cohort=name,
+                                       etag_seed=etag_seed)
+        self.sample_rate = filters['sampleRate']
+        self.products = frozenset(lower(p) for p in
+                                  filters.get('products', []))
+        self.channels = frozenset(lower(c) for c in
+                                  filters.get('channels', []))
+        self.min_version = parse_version(
+            str(filters.get('minVersion', MIN_VERSION)))
+        self.max_version = parse_version(
+            str(filters.get('maxVersion', MAX_VERSION)))
+        self.start_time = filters.get('startTime')
+        self.max_size = filters.get('maxSize')
+        # the maxSize counts the enrollments of that many minutes, if set
+        self.window = filters.get('maxSizeWindow')
+        # the (locale, territory, cohort) counter key, and its slot
+        self.key = None
+        self.slot = None
+
+    def matches(self, prod, channel):
+        if self.products and prod not in self.products:
+            return False
+        if self.channels and channel not in self.channels:
+            return False
+        return True
+
+
+class VersionIndex(object):
+    """Finds the tests whose [minVersion, maxVersion] contain a version.
+
+    The version line is cut at every bound into single points and the
+    open gaps between them, and the tests covering each piece are
+    computed upfront. A lookup is then a single bisect.
+    """
+
+    def __init__(self, tests):
+        bounds = set()
+        for test in tests:
+            bounds.add(test.min_version)
+            bounds.add(test.max_version)
+        self._bounds = bounds = sorted(bounds)
+
+        # the gaps before the first and after the last bound are empty
+        self._gaps = [()]
+        self._points = []
+        for i, bound in enumerate(bounds):
+            self._points.append(tuple(
+                test for test in tests
+                if test.min_version <= bound <= test.max_version))
+            if i + 1 < len(bounds):
+                upper = bounds[i + 1]
+                self._gaps.append(tuple(
+                    test for test in tests
+                    if test.min_version <= bound and
+                    test.max_version >= upper))
+        self._gaps.append(())
+
+    def lookup(self, version):
+        i = bisect.bisect_left(self._bounds, version)
+        if i < len(self._bounds) and self._bounds[i] == version:
+            return self._points[i]
+        return self._gaps[i]
+
+
+class AliasTable(object):
+    """Picks weighted items in O(1) with Vose's alias method.
+
+    The table is built once, then a pick is a single random draw.
+    """
+
+    def __init__(self, items, weights):
+        n = len(items)
+        total = float(sum(weights))
+        scaled = [weight * n / total for weight in weights]
+        prob = [1.] * n
+        alias = list(range(n))
+
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            prob[less] = scaled[less]
+            alias[less] = more
+            scaled[more] += scaled[less] - 1
+            if scaled[more] < 1:
+                small.append(more)
+            else:
+                large.append(more)
+
+        self._n = n
+        self._items = tuple(items)
+        self._prob = prob
+        self._alias = tuple(items[i] for i in alias)
+
+    def pick(self, random=random.random):
+        x = random() * self._n
+        i = int(x)
+        if i == self._n:
+            i -= 1
+        if x - i < self._prob[i]:
+            return self._items[i]
+        return self._alias[i]
+
+
+def cohort_weights(tests):
+    """Returns the weight of each test, and the one of the default.
+
+    Tests get their sampleRate until the rates add up to 100, and the
+    default gets whatever is left.
+    """
+    weights = []
+    previous = 0
+    for total in accumulate(test.sample_rate for test in tests):
+        weights.append(max(0, min(total, 100) - previous))
+        previous = min(total, 100)
+    return weights, 100 - previous
+
+
+class TerritoryIndex(object):
+    """The compiled settings of one (locale, territory).
+
+    The ETag of every response is derived from the version of the
+    settings, the locale, the territory and the cohort.
+
+    Only tests whose startTime has passed and that did not reach their
+    maxSize can be picked. activate() must be called once
+    next_activation is passed to index the tests that started since,
+    and saturate() when a test reaches its maxSize.
+    """
+
+    def __init__(self, locale, territory, default, tests, interval,
+                 version='', lower=str.lower, max_samplers=256, now=None):
+        self.locale = locale
+        self.territory = territory
+        self.version = version
+        etag_seed = ':'.join((version, locale, territory))
+        self.default = build_response(default, interval,
+                                      etag_seed=etag_seed + ':default')
+        self.tests = {}
+        for name, test in tests.items():
+            self.tests[name] = test = CompiledTest(
+                name, test, interval, etag_seed + ':' + name, lower)
+            test.key = locale, territory, name
+
+        # the counter key of the default cohort, and its slot
+        self.default_key = locale, territory, 'default'
+        self.default_slot = None
+
+        # tests are bucketed by every product and channel they mention,
+        # None standing for the ones no filter mentions.
+        products = set()
+        channels = set()
+        for test in self.tests.values():
+            products.update(test.products)
+            channels.update(test.channels)
+        self._products = frozenset(products)
+        self._channels = frozenset(channels)
+
+        # a sampling table for each distinct set of eligible tests,
+        # built on first use
+        self._samplers = {}
+        self._max_samplers = max_samplers
+
+        # the indexes are rebuilt, then swapped, when tests start or
+        # fill up
+        self._lock = threading.Lock()
+        self._started = ()
+        self.saturated = frozenset()
+        self._eligible = None
+        self.next_activation = None
+        self.activate(time.time() if now is None else now)
+
+    def activate(self, now):
+        """Indexes the tests started at now.
+
+        next_activation is set to the next startTime, or None.
+        """
+        with self._lock:
+            started = []
+            pending = []
+            for test in self.tests.values():
+                if test.start_time and test.start_time >= now:
+                    pending.append(test.start_time)
+                else:
+                    started.append(test)
+
+            self._started = tuple(started)
+            self._responses = dict((test.name, test.response)
+                                   for test in started)
+            self.next_activation = min(pending) if pending else None
+            self._refresh()
+
+    def saturate(self, cohort, full=True):
+        """Stops picking a cohort that reached its maxSize.
+
+        If full is False, the cohort can be picked again.
+        """
+        with self._lock:
+            if full:
+                self.saturated = self.saturated | set([cohort])
+            else:
+                self.saturated = self.saturated - set([cohort])
+            self._refresh()
+
+    def set_saturated(self, cohorts):
+        """Sets the cohorts that reached their maxSize."""
+        cohorts = frozenset(cohort for cohort in cohorts
+                            if cohort in self.tests)
+        with self._lock:
+            if cohorts != self.saturated:
+                self.saturated = cohorts
+                self._refresh()
+
+    def _refresh(self):
+        eligible = tuple(test for test in self._started
+                         if test.name not in self.saturated)
+        if eligible == self._eligible:
+            return
+
+        buckets = {}
+        for prod in list(self._products) + [None]:
+            for channel in list(self._channels) + [None]:
+                matching = [test for test in eligible
+                            if test.matches(prod, channel)]
+                buckets[prod, channel] = VersionIndex(matching)
+
+        self._buckets = buckets
+        self._eligible = eligible
+
+    def candidates(self, prod, channel, version):
+        """Returns the tests that can be picked for a product, channel
+        and version.
+        """
+        if prod not in self._products:
+            prod = None
+        if channel not in self._channels:
+            channel = None
+        return self._buckets[prod, channel].lookup(version)
+
+    def explain(self, prod, channel, version):
+        """Tells why each test can or can't be picked for a product,
+        channel and version.
+        """
+        reasons = {}
+        for name, test in self.tests.items():
+            if name not in self._responses:
+                reasons[name] = 'not started'
+            elif name in self.saturated:
+                reasons[name] = 'full'
+            elif test.products and prod not in test.products:
+                reasons[name] = 'excluded by product'
+            elif test.channels and channel not in test.channels:
+                reasons[name] = 'excluded by channel'
+            elif not test.min_version <= version <= test.max_version:
+                reasons[name] = 'excluded by version'
+            else:
+                reasons[name] = 'candidate'
+        return reasons
+
+    def responses(self):
+        """Returns the default response and the ones of every test."""
+        return [self.default] + [test.response
+                                 for test in self.tests.values()]
+
+    def response(self, cohort):
+        """Returns the response of a cohort, or the default one when
+        the cohort does not exist or is not active yet.
+        """
+        return self._responses.get(cohort, self.default)
+
+    def sampler(self, tests):
+        """Returns the table picking one of some tests, or the default.
+
+        The default is picked as None.
+        """
+        try:
+            return self._samplers[tests]
+        except KeyError:
+            pass
+
+        weights, default = cohort_weights(tests)
+        sampler = AliasTable(tests + (None,), weights + [default])
+        if len(self._samplers) >= self._max_samplers:
+            self._samplers.clear()
+        self._samplers[tests] = sampler
+        return sampler
@@ -0,0 +1,48 @@
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+class Metrics(object):
+    """In-process counters and timers, exposed by /__stats__."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(int)
+        self._timers = {}
+
+    def incr(self, name, count=1):
+        with self._lock:
+            self._counters[name] += count
+
+    def timing(self, name, duration):
+        """Records a duration, in seconds."""
+        with self._lock:
+            timer = self._timers.get(name)
+            if timer is None:
+                timer = self._timers[name] = {'count': 0, 'total': 0.,
+                                              'max': 0., 'last': 0.}
+            timer['count'] += 1
+            timer['total'] += duration
+            timer['last'] = duration
+            if duration > timer['max']:
+                timer['max'] = duration
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timing(name, time.perf_counter() - start)
+
+    def get(self, name):
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def snapshot(self):
+        with self._lock:
+            return {'counters': dict(self._counters),
+                    'timers': dict((name, dict(timer))
+                                   for name, timer in self._timers.items())}
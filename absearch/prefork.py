@@ -0,0 +1,248 @@
+"""Runs the asyncio front end in pre-forked worker processes.
+
+The parent process loads and compiles the settings once, then forks the
+workers, which share them copy-on-write. Every worker listens on the
+same port with SO_REUSEPORT, and the kernel spreads the connections
+among them.
+
+The parent restarts the workers that die, and reloads the settings
+every max_age seconds or on SIGHUP. When they changed, each worker is
+stopped and replaced by one forked with them, one after the other, so
+the whole fleet moves to the same config. The memory counters of a
+worker are handed to its replacement through a checkpoint.
+
+    absearch-prefork config/absearch.ini
+"""
+import asyncio
+import os
+import signal
+import sys
+import time
+
+from absearch import logger, server
+from absearch.aioserver import AsyncServer, _use_uvloop
+
+
+def run_worker(settings, host, port, max_connections=10000,
+               keepalive_timeout=75.):
+    """Serves until SIGTERM or SIGINT."""
+
+    async def serve():
+        loop = asyncio.get_running_loop()
+        front = AsyncServer(settings, max_connections, keepalive_timeout)
+        listener = await front.start(host, port, reuse_port=True)
+        stopped = asyncio.Event()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stopped.set)
+        await stopped.wait()
+        front.close()
+        await listener.wait_closed()
+
+    asyncio.run(serve())
+
+
+class Arbiter(object):
+    """Forks the workers, and watches them.
+
+    reload_interval is how often, in seconds, the settings are reloaded,
+    if set.
+    """
+
+    def __init__(self, settings, host, port, workers=None,
+                 max_connections=10000, keepalive_timeout=75.,
+                 reload_interval=None):
+        self.settings = settings
+        self.host = host
+        self.port = port
+        self.workers = int(workers or os.cpu_count() or 1)
+        self.max_connections = max_connections
+        self.keepalive_timeout = keepalive_timeout
+        self.reload_interval = reload_interval
+        # pid -> (worker number, generation, start time)
+        self.children = {}
+        self.generation = 0
+        self._stopping = False
+        self._reload_asked = False
+
+    def spawn(self, worker):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = worker, self.generation, time.monotonic()
+            return pid
+
+        # we're the worker
+        code = 0
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            self.settings.after_fork(worker)
+            run_worker(self.settings, self.host, self.port,
+                       self.max_connections, self.keepalive_timeout)
+        except BaseException:
+            logger.exception('Worker %d failed' % worker)
+            code = 1
+        finally:
+            try:
+                self.settings.close()
+            except Exception:
+                logger.exception('Could not close the settings')
+            # not running what the parent registered
+            os._exit(code)
+
+    def _prepare(self):
+        # the threads would not be carried by the fork
+        self.settings.compile_all()
+        self.settings.before_fork()
+
+    def spawn_all(self):
+        self._prepare()
+        for worker in range(self.workers):
+            self.spawn(worker)
+
+    def reap(self):
+        """Restarts the workers of the current generation that died."""
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+
+            child = self.children.pop(pid, None)
+            if child is None:
+                continue
+            worker, generation, started = child
+            if self._stopping or generation != self.generation:
+                continue
+
+            logger.error('Worker %d (pid %d) died with status %d' %
+                         (worker, pid, status))
+            if time.monotonic() - started < 1:
+                # don't fork in a loop if it dies right away
+                time.sleep(1)
+            self.spawn(worker)
+
+    def reload(self):
+        """Forks a new generation of workers if the settings changed."""
+        try:
+            changed = self.settings.load()
+        except Exception:
+            logger.exception('Could not reload the config')
+            return False
+        if not changed:
+            return False
+
+        logger.info('The config changed, replacing the workers')
+        previous = sorted(self.children.items(),
+                          key=lambda child: child[1][0])
+        self.generation += 1
+        self._prepare()
+        for pid, (worker, generation, started) in previous:
+            # a worker checkpoints its counters as it exits, and the one
+            # replacing it reads them back
+            self._wait(pid)
+            self.settings.worker_exited()
+            self.spawn(worker)
+        return True
+
+    def _wait(self, pid, timeout=10.):
+        """Stops a worker, killing it if it's still there after timeout
+        seconds.
+        """
+        self._kill(pid, signal.SIGTERM)
+        deadline = time.monotonic() + timeout
+        try:
+            while time.monotonic() < deadline:
+                if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                    break
+                time.sleep(.05)
+            else:
+                self._kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+        except ChildProcessError:
+            pass
+        self.children.pop(pid, None)
+
+    def _kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def _ask_stop(self, signum, frame):
+        self._stopping = True
+
+    def _ask_reload(self, signum, frame):
+        self._reload_asked = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._ask_stop)
+        signal.signal(signal.SIGINT, self._ask_stop)
+        signal.signal(signal.SIGHUP, self._ask_reload)
+
+        self.spawn_all()
+        next_reload = None
+        if self.reload_interval:
+            next_reload = time.monotonic() + self.reload_interval
+
+        while not self._stopping:
+            self.reap()
+            if self._reload_asked or (next_reload is not None and
+                                      time.monotonic() >= next_reload):
+                self._reload_asked = False
+                if next_reload is not None:
+                    next_reload = time.monotonic() + self.reload_interval
+                self.reload()
+            time.sleep(.2)
+
+        self.stop()
+
+    def stop(self, timeout=10.):
+        """Stops the workers, killing the ones still there after timeout
+        seconds.
+        """
+        self._stopping = True
+        for pid in list(self.children):
+            self._kill(pid, signal.SIGTERM)
+
+        deadline = time.monotonic() + timeout
+        while self.children and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(.05)
+
+        for pid in list(self.children):
+            self._kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            del self.children[pid]
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+
+    if len(args) > 0:
+        config = args[0]
+    else:
+        config = os.path.join(os.path.dirname(__file__), '..', 'config',
+                              'absearch.ini')
+
+    server.initialize_app(config)
+    abconf = server.app._config['absearch']
+    settings = server.app.settings
+    if abconf.get('event_loop', 'asyncio') == 'uvloop':
+        _use_uvloop()
+
+    # the parent reloads for everyone
+    reload_interval = settings.max_age
+    settings.max_age = None
+
+    arbiter = Arbiter(settings, abconf['host'], abconf['port'],
+                      abconf.get('workers', 0),
+                      abconf.get('max_connections', 10000),
+                      abconf.get('keepalive_timeout', 75),
+                      reload_interval)
+    logger.info('Serving on %s:%s with %d workers' % (
+        abconf['host'], abconf['port'], arbiter.workers))
+    arbiter.run()
@@ -0,0 +1,58 @@
+import hashlib
+import json
+import os
+
+
+class FileReader(object):
+    """Reads a JSON file, returning its content and md5.
+
+    changed() tells cheaply if the file differs from a previous read:
+    its size and modification time are compared first, and the file is
+    hashed without being parsed only when they changed.
+    """
+
+    def __init__(self, path, chunk_size=64 * 1024):
+        self.path = path
+        self.chunk_size = chunk_size
+        self._stat = None
+
+    def _get_stat(self):
+        stat = os.stat(self.path)
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns
+
+    def md5(self):
+        hash = hashlib.md5()
+        with open(self.path, 'rb') as f:
+            for chunk in iter(lambda: f.read(self.chunk_size), b''):
+                hash.update(chunk)
+        return hash.hexdigest()
+
+    def changed(self, md5):
+        """Tells if the file content may differ from md5."""
+        try:
+            stat = self._get_stat()
+        except OSError:
+            # let the next read raise
+            return True
+
+        if stat == self._stat:
+            return False
+
+        # the file was touched, but maybe not changed
+        if self.md5() == md5:
+            self._stat = stat
+            return False
+
+        return True
+
+    def __call__(self):
+        # stat before reading, so a change made while we read is seen
+        # by the next call to changed()
+        stat = self._get_stat()
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        self._stat = stat
+        return (
+            json.loads(data.decode('utf8')),
+            hashlib.md5(data).hexdigest(),
+        )
@@ -0,0 +1,310 @@
+"""Cohort counters shared by a fleet through a Redis server.
+
+Increments are counted locally and written behind, in pipelined batches,
+so requests never wait for Redis.
+"""
+import socket
+import threading
+import time
+from array import array
+
+from absearch import logger
+from absearch.counters import CohortCounters
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisClient(object):
+    """A minimal client speaking the Redis protocol (RESP)."""
+
+    def __init__(self, host='localhost', port=6379, timeout=1.,
+                 password=None, db=0):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.password = password
+        self.db = db
+        self._sock = None
+        self._file = None
+
+    def connect(self):
+        self.close()
+        self._sock = socket.create_connection((self.host, self.port),
+                                              self.timeout)
+        self._file = self._sock.makefile('rb')
+        setup = []
+        if self.password:
+            setup.append(('AUTH', self.password))
+        if self.db:
+            setup.append(('SELECT', self.db))
+        for reply in self._execute(setup):
+            if isinstance(reply, RedisError):
+                raise reply
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._file.close()
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = self._file = None
+
+    def _encode(self, command):
+        parts = [b'*%d\r\n' % len(command)]
+        for arg in command:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode('utf8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(parts)
+
+    def _read_reply(self):
+        line = self._file.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError('Connection closed by the server')
+        kind, data = line[:1], line[1:-2]
+        if kind == b'+':
+            return data.decode('utf8')
+        if kind == b'-':
+            return RedisError(data.decode('utf8'))
+        if kind == b':':
+            return int(data)
+        if kind == b'$':
+            length = int(data)
+            if length == -1:
+                return None
+            return self._file.read(length + 2)[:-2]
+        if kind == b'*':
+            length = int(data)
+            if length == -1:
+                return None
+            return [self._read_reply() for i in range(length)]
+        raise RedisError('Unknown reply %r' % line)
+
+    def _execute(self, commands):
+        if not commands:
+            return []
+        self._sock.sendall(b''.join(self._encode(command)
+                                    for command in commands))
+        return [self._read_reply() for command in commands]
+
+    def pipeline(self, commands):
+        """Sends some commands at once, and returns their replies.
+
+        Error replies are returned as RedisError instances.
+        """
+        if not commands:
+            return []
+        if self._sock is None:
+            self.connect()
+        try:
+            return self._execute(commands)
+        except (OSError, ValueError):
+            # we don't know what was read, the connection can't be reused
+            self.close()
+            raise
+
+
+class RedisCohortCounters(CohortCounters):
+    """Counters shared through Redis, with write-behind increments.
+
+    Every update is applied to a local estimate right away, and kept as
+    a pending delta. Every flush_interval seconds a thread sends the
+    deltas in one pipeline of INCRBY, whose replies update the estimates
+    with the increments of the other hosts. The counters of the cohorts
+    that have a maxSize are read again at least every max_staleness
+    seconds, so a cohort filled by the other hosts is seen.
+
+    Capacity windows are counted by each host.
+
+    If Redis can't be reached, counting goes on locally and the deltas
+    are sent once it's back. Keys without a slot are only counted
+    locally.
+
+    The counters are read from Redis by the first flush after
+    set_slots(), so loading a config never waits for Redis.
+
+    With a flush_interval of 0, no thread is started and flush() must be
+    called.
+    """
+
+    def __init__(self, host='localhost', port=6379, prefix='absearch',
+                 flush_interval=1., max_staleness=5., timeout=1.,
+                 password=None, db=0, stripes=64, clock=time.time, **kw):
+        self.prefix = prefix
+        self.flush_interval = float(flush_interval)
+        self.max_staleness = float(max_staleness)
+        self.connected = True
+        self._client = RedisClient(host, int(port), float(timeout),
+                                   password, int(db))
+        self._flush_lock = threading.Lock()
+        self._refreshed = 0
+        # the layout whose counters were not all read yet
+        self._unrefreshed = None
+        self._stopped = threading.Event()
+        self._flusher = None
+        super(RedisCohortCounters, self).__init__(stripes, clock)
+        self._start()
+
+    def _start(self):
+        if self.flush_interval > 0:
+            self._stopped = threading.Event()
+            self._flusher = threading.Thread(target=self._flush_loop,
+                                             name='absearch-redis-flusher')
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def _stop(self):
+        self._stopped.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+
+    def _allocate(self, keys, previous):
+        layout = super(RedisCohortCounters, self)._allocate(keys, previous)
+        layout.pending = array('q', [0]) * len(keys)
+        layout.names = ['%s:%s' % (self.prefix, ':'.join(key))
+                        for key in keys]
+        if previous is not None:
+            # deltas not sent yet are kept
+            for slot, key in enumerate(keys):
+                if key in previous.slots:
+                    layout.pending[slot] = previous.pending[
+                        previous.slots[key]]
+        return layout
+
+    def _update(self, layout, slot, value):
+        layout.pending[slot] += value
+        layout.values[slot] += value
+        return layout.values[slot]
+
+    def set_slots(self, keys, version=None):
+        super(RedisCohortCounters, self).set_slots(keys, version)
+        # the next flush gets the current values of the fleet; the known
+        # ones are used until then
+        self._unrefreshed = self._layout
+
+    def _flush_loop(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Could not flush the counters')
+
+    def _take_pending(self, layout):
+        deltas = {}
+        for slot in range(len(layout.keys)):
+            if not layout.pending[slot]:
+                continue
+            with self._locks[slot % len(self._locks)]:
+                if self._layout is not layout:
+                    # the deltas were carried to the new layout
+                    break
+                deltas[slot] = layout.pending[slot]
+                layout.pending[slot] = 0
+        return deltas
+
+    def _give_back(self, layout, deltas):
+        for slot, delta in deltas.items():
+            key = layout.keys[slot]
+            while True:
+                current = self._layout
+                new_slot = current.slots.get(key)
+                if new_slot is None:
+                    # the cohort is gone
+                    break
+                with self._locks[new_slot % len(self._locks)]:
+                    if self._layout is current:
+                        current.pending[new_slot] += delta
+                        break
+
+    def flush(self, refresh_all=False):
+        """Sends the pending deltas.
+
+        The counters of the capped cohorts are read too if they're older
+        than max_staleness, and all the counters if refresh_all is True
+        or if they were laid out since the last flush.
+        """
+        with self._flush_lock:
+            layout = self._layout
+            if not layout.keys:
+                return
+
+            refresh_all = refresh_all or self._unrefreshed is layout
+            now = self._clock()
+            refresh = (refresh_all or
+                       now - self._refreshed >= self.max_staleness)
+            deltas = self._take_pending(layout)
+            slots = sorted(deltas)
+            commands = [('INCRBY', layout.names[slot], deltas[slot])
+                        for slot in slots]
+            if refresh:
+                for slot in range(len(layout.keys)):
+                    if slot in deltas:
+                        continue
+                    if refresh_all or layout.limits[slot]:
+                        slots.append(slot)
+                        commands.append(('GET', layout.names[slot]))
+
+            try:
+                replies = self._client.pipeline(commands)
+            except (OSError, ValueError) as e:
+                self._give_back(layout, deltas)
+                if self.connected:
+                    logger.warning('Redis is unreachable, counting locally'
+                                   ' (%s)' % e)
+                self.connected = False
+                return
+
+            if not self.connected:
+                logger.info('Redis is back')
+            self.connected = True
+            if refresh:
+                self._refreshed = now
+
+            errors = 0
+            failed = {}
+            for slot, reply in zip(slots, replies):
+                if isinstance(reply, RedisError):
+                    logger.error('Could not update %s (%s)' %
+                                 (layout.names[slot], reply))
+                    errors += 1
+                    if slot in deltas:
+                        failed[slot] = deltas[slot]
+            # sent again with the next flush
+            self._give_back(layout, failed)
+            if refresh_all and not errors and self._unrefreshed is layout:
+                self._unrefreshed = None
+
+            for slot, reply in zip(slots, replies):
+                if isinstance(reply, RedisError):
+                    continue
+                key = layout.keys[slot]
+                value = int(reply or 0)
+                with self._locks[slot % len(self._locks)]:
+                    if self._layout is not layout:
+                        break
+                    # the fleet's value, plus what we counted meanwhile
+                    value += layout.pending[slot]
+                    layout.values[slot] = value
+                    # windows are counted locally
+                    if layout.limits[slot] and key not in self._windows:
+                        self._changed(key, value)
+
+    def close(self):
+        self._stop()
+        try:
+            self.flush()
+        finally:
+            self._client.close()
+
+    def before_fork(self):
+        self._stop()
+        self.flush()
+
+    def after_fork(self, worker=0):
+        # the connection belongs to the parent
+        self._client.close()
+        self._start()
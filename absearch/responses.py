@@ -0,0 +1,165 @@
+"""Read-only response documents, built and encoded once per config load.
+
+Their bodies are compressed at the same time, with gzip and, when the
+brotli module is installed, brotli.
+"""
+import copy
+import gzip
+import hashlib
+import json
+from functools import lru_cache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+ALLOWED_KEYS = ('cohort', 'settings', 'interval')
+
+# the content codings of the compressed bodies, preferred first
+ENCODINGS = ('gzip',)
+if brotli is not None:
+    ENCODINGS = ('br',) + ENCODINGS
+
+
+class FrozenDict(dict):
+    """A dict that can't be modified.
+
+    Responses are shared by every request, so they must never change
+    once built. Copies are plain, mutable dicts.
+    """
+
+    __slots__ = ()
+
+    def _readonly(self, *args, **kw):
+        raise TypeError('%s is read-only' % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = __ior__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return dict((key, copy.deepcopy(value, memo))
+                    for key, value in self.items())
+
+    def __reduce__(self):
+        return self.__class__, (dict(self),)
+
+
+def _compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body)
+    # no timestamp, so the same body gives the same bytes
+    return gzip.compress(body, 9, mtime=0)
+
+
+@lru_cache(maxsize=256)
+def accepted_encodings(accept_encoding):
+    """Returns the ENCODINGS an Accept-Encoding header allows, by
+    decreasing quality, in the order of ENCODINGS for the same one.
+    """
+    if not accept_encoding:
+        return ()
+    qualities = {}
+    for coding in accept_encoding.lower().split(','):
+        name, _, params = coding.partition(';')
+        quality = 1.
+        params = params.replace(' ', '')
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.
+        qualities[name.strip()] = quality
+
+    accepted = []
+    for rank, encoding in enumerate(ENCODINGS):
+        quality = qualities.get(encoding, qualities.get('*', 0.))
+        if quality > 0:
+            accepted.append((-quality, rank, encoding))
+    # the preferred codings of the client first, then ours
+    return tuple(encoding for _, _, encoding in sorted(accepted))
+
+
+class Response(FrozenDict):
+    """A read-only response, with its JSON body and strong ETag.
+
+    variants holds the (body, etag) of each content coding that makes
+    the body smaller.
+    """
+
+    __slots__ = ('body', 'etag', 'variants')
+
+    def variant(self, accept_encoding=None):
+        """Returns the content coding, body and ETag to send for an
+        Accept-Encoding header. The coding is None for the plain body.
+        """
+        for encoding in accepted_encodings(accept_encoding):
+            if encoding in self.variants:
+                body, etag = self.variants[encoding]
+                return encoding, body, etag
+        return None, self.body, self.etag
+
+    def sizes(self):
+        """Returns the size of the body for every content coding."""
+        sizes = {'identity': len(self.body)}
+        for encoding in ENCODINGS:
+            body = self.variants.get(encoding, (self.body,))[0]
+            sizes[encoding] = len(body)
+        return sizes
+
+
+def freeze(data):
+    """Returns a read-only deep copy of some JSON data."""
+    if isinstance(data, dict):
+        return FrozenDict((key, freeze(value))
+                          for key, value in data.items())
+    if isinstance(data, (list, tuple)):
+        return tuple(freeze(value) for value in data)
+    return data
+
+
+def build_response(data, interval, cohort=None, etag_seed=''):
+    """Builds the response sent back for some default or test settings.
+
+    Only the allowed keys are kept, and the interval is added when the
+    settings don't have one. etag_seed must identify the settings and
+    the config version they come from.
+    """
+    res = dict((key, value) for key, value in data.items()
+               if key in ALLOWED_KEYS)
+    if cohort is not None:
+        res['cohort'] = cohort
+    if 'interval' not in res:
+        res['interval'] = interval
+
+    res = Response(freeze(res))
+    res.body = json.dumps(res, separators=(',', ':')).encode('utf8')
+    digest = hashlib.md5(etag_seed.encode('utf8')).hexdigest()
+    res.etag = '"%s"' % digest
+    res.variants = {}
+    for encoding in ENCODINGS:
+        body = _compress(res.body, encoding)
+        if len(body) < len(res.body):
+            # every representation has its own strong ETag
+            res.variants[encoding] = body, '"%s-%s"' % (digest, encoding)
+    return res
+
+
+def etag_matches(if_none_match, etag):
+    """Tells if an If-None-Match header matches an ETag."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        # If-None-Match uses the weak comparison
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
@@ -1,17 +1,21 @@
+import atexit
 import sys
 import datetime
 import os
 import json
 import logging.config
-import hashlib
+import time
+from urllib.parse import parse_qsl
 
 from konfig import Config
 from bottle import (
-    Bottle, HTTPError, TEMPLATE_PATH, request, response)
+    Bottle, HTTPError, TEMPLATE_PATH, request, response, run)
 from raven import Client as Sentry
 
 from absearch import __version__
+from absearch.readers import FileReader
 from absearch.settings import SearchSettings
+from absearch.responses import etag_matches
 from absearch import logger
 
 
@@ -23,17 +27,22 @@ X_CONTENT_TYPE_OPTIONS = "nosniff"
 STRICT_TRANSPORT_SECURITY = "max-age=15768000"
 CSP = "default-src 'none'; frame-ancestors 'none'"
 
+COMMON_HEADERS = [
+    ('Cache-Control', 'max-age=%d' % CACHE_CONTROL_MAX_AGE),
+    ('Pragma', 'max-age=%d' % CACHE_CONTROL_MAX_AGE),
+    ('X-Frame-Options', X_FRAME_OPTIONS),
+    ('X-Content-Type-Options', X_CONTENT_TYPE_OPTIONS),
+    ('Content-Security-Policy', CSP)]
+JSON_HEADERS = COMMON_HEADERS + [('Content-Type', 'application/json')]
+VARY = ('Vary', 'Accept-Encoding')
+
 app = Bottle()
 summary_logger = logging.getLogger("request.summary")
 
 
 def set_headers():
-    cache_control = "max-age={max_age}".format(max_age=CACHE_CONTROL_MAX_AGE)
-    response.set_header("Cache-Control", cache_control)
-    response.set_header("Pragma", cache_control)
-    response.set_header("X-Frame-Options", X_FRAME_OPTIONS)
-    response.set_header("X-Content-Type-Options", X_CONTENT_TYPE_OPTIONS)
-    response.set_header("Content-Security-Policy", CSP)
+    for name, value in COMMON_HEADERS:
+        response.set_header(name, value)
 
 
 def before_request():
@@ -85,29 +94,32 @@ def initialize_app(config):
     datadir = app._config['directory']['path']
     logger.info("Read config and schema from %r on disk" % datadir)
 
-    def config_reader():
-        with open(os.path.join(datadir, configfile)) as f:
-            data = f.read()
-            return (
-                json.loads(data),
-                hashlib.md5(data.encode("utf8")).hexdigest(),
-            )
-
-    def schema_reader():
-        with open(os.path.join(datadir, schemafile)) as f:
-            data = f.read()
-            return (
-                json.loads(data),
-                hashlib.md5(data.encode("utf8")).hexdigest(),
-            )
+    config_reader = FileReader(os.path.join(datadir, configfile))
+    schema_reader = FileReader(os.path.join(datadir, schemafile))
 
     # counter configuration
     counter = app._config['absearch']['counter']
     counter_options = {}
+    if app._config.has_section('counter'):
+        counter_options = app._config.get_map('counter')
 
     max_age = app._config['absearch']['max_age']
+    background_reload = app._config['absearch'].get('background_reload',
+                                                    False)
+    cohort_cache_size = app._config['absearch'].get('cohort_cache_size',
+                                                    1024)
+    lazy = app._config['absearch'].get('lazy', False)
+    warm_locales = app._config['absearch'].get('warm_locales', [])
+    if isinstance(warm_locales, str):
+        warm_locales = warm_locales.split()
+
     app.settings = SearchSettings(config_reader, schema_reader, counter,
-                                  counter_options, max_age)
+                                  counter_options, max_age,
+                                  background_reload=background_reload,
+                                  lazy=lazy, warm_locales=warm_locales,
+                                  cohort_cache_size=cohort_cache_size)
+    # the counters may have something to save
+    atexit.register(app.settings.close)
 
 
 @app.route('/')
@@ -127,17 +139,23 @@ def lhb():
 @app.route('/__heartbeat__')
 def hb():
 
-    res = app.settings.get('firefox', '39', 'default', 'en-US', 'US',
-                           'default', 'default')
-
-    incremented_cohort = res.get('cohort', 'default')
-
-    # let's decrement so we don't interfer with real counters
-    app.settings._counters.decr('en-US', 'US', incremented_cohort)
+    # the settings are resolved without touching the counters
+    app.settings.evaluate('firefox', '39', 'default', 'en-US', 'US',
+                          'default', 'default')
     return {'config_md5': app.settings.config_md5,
             'schema_md5': app.settings.schema_md5}
 
 
+@app.route('/__stats__')
+def stats():
+    res = app.settings.metrics.snapshot()
+    res['saturated'] = ['.'.join(key)
+                        for key in app.settings.saturated_cohorts()]
+    res['invalid'] = app.settings.invalid_locales()
+    res['sizes'] = app.settings.response_sizes()
+    return res
+
+
 @app.route('/__info__')
 def info():
     return {'version': __version__}
@@ -172,6 +190,109 @@ def handle_404_error(code):
     response.content_type = 'application/json'
 
 
+def send_response(res):
+    # the body was encoded and compressed when the config was loaded
+    encoding, body, etag = res.variant(
+        request.headers.get('Accept-Encoding'))
+    response.set_header('Vary', 'Accept-Encoding')
+    response.set_header('ETag', etag)
+    if etag_matches(request.headers.get('If-None-Match'), etag):
+        response.status = 304
+        return b''
+    response.content_type = 'application/json'
+    if encoding is not None:
+        response.set_header('Content-Encoding', encoding)
+    return body
+
+
+def answer(settings, args, if_none_match=None, accept_encoding=None):
+    """Returns the status, headers and body answering a /1/ request.
+
+    args are the segments of the path after /1/.
+    """
+    try:
+        res = settings.get(*args)
+    except ValueError:
+        return 404, JSON_HEADERS, b''
+    encoding, body, etag = res.variant(accept_encoding)
+    if etag_matches(if_none_match, etag):
+        return 304, COMMON_HEADERS + [VARY, ('ETag', etag)], b''
+    if encoding is None:
+        return 200, JSON_HEADERS + [VARY, ('ETag', etag)], body
+    return 200, JSON_HEADERS + [VARY, ('ETag', etag),
+                                ('Content-Encoding', encoding)], body
+
+
+_STATUSES = {200: '200 OK', 304: '304 Not Modified', 404: '404 Not Found',
+             500: '500 Internal Server Error'}
+
+
+class FastRouter(object):
+    """A WSGI app answering the /1/ and __lbheartbeat__ requests.
+
+    Those are matched with one split, and answered from the settings
+    without Bottle's routing and hooks. The other requests are passed to
+    the Bottle app.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        started = time.perf_counter()
+        method = environ['REQUEST_METHOD']
+        if method not in ('GET', 'HEAD'):
+            return self.app(environ, start_response)
+
+        # decoded like Bottle does
+        path = environ.get('PATH_INFO', '/').encode('latin1')
+        path = path.decode('utf8', 'ignore')
+        if path == '/__lbheartbeat__':
+            status, headers, body = 200, JSON_HEADERS, b'{}'
+        else:
+            segments = path.split('/')
+            # /1/<prod>/<ver>/<channel>/<locale>/<territory>/<dist>/<distver>
+            # and /<cohort>
+            if (len(segments) not in (9, 10) or segments[1] != '1' or
+                    not all(segments[2:])):
+                return self.app(environ, start_response)
+            try:
+                status, headers, body = answer(
+                    self.app.settings, segments[2:],
+                    environ.get('HTTP_IF_NONE_MATCH'),
+                    environ.get('HTTP_ACCEPT_ENCODING'))
+            except Exception:
+                handle_500_error(500)
+                status, headers, body = 500, COMMON_HEADERS, b''
+
+        if summary_logger.isEnabledFor(logging.INFO):
+            self._log(environ, method, path, status, started)
+
+        start_response(_STATUSES[status], headers + [
+            ('Content-Length', str(len(body)))])
+        if method == 'HEAD':
+            return [b'']
+        return [body]
+
+    def _log(self, environ, method, path, status, started):
+        context = dict(
+            agent=environ.get('HTTP_USER_AGENT'),
+            path=path,
+            method=method,
+            lang=environ.get('HTTP_ACCEPT_LANGUAGE'),
+            code=status,
+            time=datetime.datetime.now().isoformat(),
+            t=(time.perf_counter() - started) * 1000,  # msec
+        )
+        query = environ.get('QUERY_STRING')
+        if query:
+            context['qs'] = dict(parse_qsl(query))
+        summary_logger.info('', extra=context)
+
+
+wsgi_app = FastRouter(app)
+
+
 @app.route(PATH)
 def add_user_to_cohort(**kw):
     try:
@@ -184,7 +305,7 @@ def add_user_to_cohort(**kw):
         locale = kw['locale']
         territory = kw['territory']
         cohort = '.'.join([locale, territory, cohort])
-    return res
+    return send_response(res)
 
 
 @app.route('%s/<cohort>' % PATH)
@@ -193,7 +314,7 @@ def get_cohort_settings(**kw):
         asked_cohort = kw['cohort']
         res = app.settings.get(**kw)
         if asked_cohort == 'default':
-            return res
+            return send_response(res)
 
         cohort = res.get('cohort', 'default')
         locale = kw['locale']
@@ -201,7 +322,7 @@ def get_cohort_settings(**kw):
         asked_cohort = '.'.join([locale, territory, asked_cohort])
         cohort = '.'.join([locale, territory, cohort])
 
-        return res
+        return send_response(res)
 
     except ValueError:
         raise HTTPError(status=404)
@@ -220,6 +341,10 @@ def main(args=None):
     initialize_app(config)
     abconf = app._config['absearch']
 
-    app.run(host=abconf['host'], port=abconf['port'],
-            server=abconf['server'], debug=abconf['debug'],
-            quiet=abconf.get('quiet', not abconf['debug']))
+    if abconf.get('fast_router', True):
+        served = wsgi_app
+    else:
+        served = app
+    run(served, host=abconf['host'], port=abconf['port'],
+        server=abconf['server'], debug=abconf['debug'],
+        quiet=abconf.get('quiet', not abconf['debug']))
@@ -1,34 +1,34 @@
+import hashlib
+import json
+import threading
 import time
 from collections import defaultdict
-import random
-import operator
-import bisect
 from string import ascii_lowercase, ascii_uppercase, digits
-import copy
 import re
 
-from jsonschema import validate
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
 
 from absearch import logger
-from absearch.counters import MemoryCohortCounters
+from absearch.cache import LRUCache
+from absearch.counters import MemoryCohortCounters, SharedCohortCounters
 from absearch.exceptions import ReadError
-
-from distutils.version import LooseVersion
+from absearch.index import (PrefixMatcher, TerritoryIndex, cohort_weights,
+                            parse_version)
+from absearch.metrics import Metrics
+from absearch.redis_counters import RedisCohortCounters
+from absearch.responses import build_response
 
 # 3600 seconds (1 hour) * 24 hours * 3 days
 DEFAULT_INTERVAL = 3600 * 24 * 3
 
+_NEVER = float('inf')
 
-def accumulate(iterable):
-    it = iter(iterable)
-    try:
-        total = next(it)
-    except StopIteration:
-        return
-    yield total
-    for element in it:
-        total = operator.add(total, element)
-        yield total
+COUNTER_BACKENDS = {
+    'memory': MemoryCohortCounters,
+    'shared': SharedCohortCounters,
+    'redis': RedisCohortCounters,
+}
 
 
 _O = ascii_uppercase + ascii_lowercase + digits + '.-'
@@ -44,92 +44,701 @@ def _lower(s):
         return s.lower()
 
 
+def _subtree_md5(data, interval):
+    # the responses of a subtree depend on it and on the interval
+    dump = json.dumps([data, interval], sort_keys=True, separators=(',', ':'))
+    return hashlib.md5(dump.encode('utf8')).hexdigest()
+
+
+def _territory_settings(territory, data):
+    # the default settings and the tests of a territory
+    if territory == 'default':
+        # fallback territory
+        return data, {}
+    # default settings
+    return data['default'], data.get('tests', {})
+
+
+def _scan_locale(locale, locale_data):
+    """Returns the territories of a locale, the counter keys of its
+    cohorts, and the capacities and windows of the ones that have a
+    maxSize.
+    """
+    territories = []
+    keys = []
+    capacities = {}
+    windows = {}
+    for territory, data in locale_data.items():
+        territory = _lower(territory)
+        territories.append(territory)
+
+        default, tests = _territory_settings(territory, data)
+        keys.append((locale, territory, 'default'))
+        for cohort, test in tests.items():
+            key = locale, territory, cohort
+            keys.append(key)
+            filters = test['filters']
+            size = filters.get('maxSize')
+            if not size:
+                continue
+            window = filters.get('maxSizeWindow')
+            for value in (size, window or 1):
+                if not isinstance(value, int) or isinstance(value, bool):
+                    raise ValueError('Invalid maxSize of %r' % (key,))
+            capacities[key] = size
+            if window:
+                windows[key] = window
+    return territories, keys, capacities, windows
+
+
+def _split_schema(schema):
+    """Splits a schema into one checking the config but the content of
+    its locales, and one checking {'locales': {name: locale}} documents.
+    """
+    properties = schema.get('properties', {})
+    locales = properties.get('locales', {})
+    shallow = dict((key, value) for key, value in locales.items()
+                   if key not in ('properties', 'patternProperties',
+                                  'additionalProperties'))
+    top = dict(schema, properties=dict(properties, locales=shallow))
+    one = dict((key, value) for key, value in locales.items()
+               if key not in ('required', 'minProperties', 'maxProperties'))
+    single = dict(schema, properties={'locales': one}, required=['locales'])
+    return top, single
+
+
+class Snapshot(object):
+    """Everything built from one version of the config.
+
+    A snapshot is never modified once built, so a new config is applied
+    by swapping the whole snapshot with a single assignment. Only the set
+    of active tests changes, when activate() is called once the time
+    is past next_activation.
+
+    Every (locale, territory) is compiled from its subtree, identified
+    by its md5. The indexes of the subtrees that did not change since
+    the previous snapshot are reused, with their responses, ETags and
+    caches.
+
+    When lazy is True, a locale is compiled the first time index() is
+    asked for it, once validate(name, data) accepted its subtree. An
+    invalid locale is then served like an unknown one.
+    """
+
+    def __init__(self, config, config_md5, schema_md5=None, now=None,
+                 previous=None, lazy=False, validate=None, clock=time.time,
+                 metrics=None, cache_size=0, on_capacities=None):
+        if now is None:
+            now = clock()
+        self.config_md5 = config_md5
+        self.schema_md5 = schema_md5
+        self.default_interval = config.get('defaultInterval',
+                                           DEFAULT_INTERVAL)
+        self.interval_response = build_response(
+            {}, self.default_interval,
+            etag_seed='interval:%s' % self.default_interval)
+
+        prefixes = config['excludedDistributionIDPrefixes']
+        if previous is not None and previous.prefixes == prefixes:
+            self.excluded = previous.excluded
+        else:
+            self.excluded = PrefixMatcher(prefixes)
+        self.prefixes = prefixes
+
+        self.locales = {}
+        self.territories = defaultdict(list)
+        # the (locale, territory) compiled for this snapshot
+        self.rebuilt = []
+        # the locales that could not be validated
+        self.invalid = []
+        self._clock = clock
+        self._validate = validate
+        self._metrics = metrics
+        # called when the capacities change after the snapshot is built
+        self._on_capacities = on_capacities
+        # the responses of explicit cohorts, by request
+        self._cache_size = cache_size
+        self.cohort_cache = LRUCache(cache_size, metrics, 'cohort_cache')
+        self._compile_lock = threading.Lock()
+        # the locales to compile, and the indexes they may reuse
+        self._sources = {}
+        self._reusable = {}
+        # the saturated cohorts of every (locale, territory), compiled
+        # or not
+        self._state_lock = threading.Lock()
+        self._saturated = {}
+        # the locales the previous snapshot did not compile yet, kept in
+        # case they're invalid in this one
+        self._fallbacks = {}
+        if previous is not None:
+            self._reusable = dict(previous.locales)
+            self._saturated = dict(previous._saturated)
+            with previous._compile_lock:
+                self._fallbacks = dict(
+                    (locale, source)
+                    for locale, source in previous._sources.items()
+                    if locale not in previous._unreadable)
+
+        # every counter key gets a slot, and the tests that have a
+        # maxSize a capacity, maybe per window. They're read from the
+        # config, so they're known before the locales are compiled.
+        keys = []
+        self.capacities = {}
+        self.windows = {}
+        # the locales whose cohorts could not be read, in lazy mode
+        self._unreadable = set()
+        for name, locale_data in config['locales'].items():
+            locale = _lower(name)
+            self._sources[locale] = name, locale_data
+            try:
+                found = _scan_locale(locale, locale_data)
+            except Exception:
+                if validate is None:
+                    raise
+                # it's invalid, and will be found so when compiled
+                logger.warning('Could not read the cohorts of locale %r' %
+                               name)
+                self._unreadable.add(locale)
+                self.territories[locale] = []
+                continue
+
+            territories, locale_keys, capacities, windows = found
+            self.territories[locale] = territories
+            keys.extend(locale_keys)
+            self.capacities.update(capacities)
+            self.windows.update(windows)
+
+        # the keys of the settings kept for invalid locales
+        self._config_keys = keys
+        self._kept_keys = []
+        if previous is not None and validate is not None:
+            # a locale found invalid later on keeps its previous settings,
+            # their counters are kept until then
+            keys = list(keys)
+            known = set(keys)
+            for key in previous._config_keys + previous._kept_keys:
+                if key not in known and key[0] in self._sources:
+                    keys.append(key)
+                    known.add(key)
+
+        self.slots = sorted(keys)
+        self._slots = dict((key, slot) for slot, key in enumerate(self.slots))
+
+        self._activation_lock = threading.Lock()
+        self._schedule()
+        if not lazy:
+            for locale in list(self._sources):
+                self.compile(locale, now)
+
+    def index(self, locale, territory):
+        """Returns the index of a (locale, territory), or None."""
+        index = self.locales.get((locale, territory))
+        if index is None and locale in self._sources:
+            self.compile(locale)
+            index = self.locales.get((locale, territory))
+        return index
+
+    def compile_all(self):
+        for locale in list(self._sources):
+            self.compile(locale)
+
+    def compile(self, locale, now=None):
+        """Builds the indexes of a locale, unless it's done already.
+
+        When the locale is invalid, the settings it had in the previous
+        snapshot are kept.
+        """
+        if locale not in self._sources:
+            return
+        with self._compile_lock:
+            if locale not in self._sources:
+                return
+            name, locale_data = self._valid_source(locale)
+
+            if now is None:
+                now = self._clock()
+            indexes = {}
+            if locale_data is None:
+                # the last compiled indexes, if any
+                for key in [key for key in self._reusable
+                            if key[0] == locale]:
+                    indexes[key] = self._reusable.pop(key)
+            else:
+                for territory, data in locale_data.items():
+                    territory = _lower(territory)
+                    md5 = _subtree_md5(data, self.default_interval)
+                    index = self._reusable.pop((locale, territory), None)
+                    if index is None or index.version != md5:
+                        default, tests = _territory_settings(territory,
+                                                             data)
+                        index = TerritoryIndex(
+                            locale, territory, default, tests,
+                            self.default_interval, md5, lower=_lower,
+                            now=now)
+                        self.rebuilt.append((locale, territory))
+                        if self._metrics is not None:
+                            self._metrics.incr('config.rebuilt_territories')
+                    indexes[locale, territory] = index
+
+            # the keys of previous settings may have no slot, they're
+            # counted by key then
+            for index in indexes.values():
+                index.default_slot = self._slots.get(index.default_key)
+                for test in index.tests.values():
+                    test.slot = self._slots.get(test.key)
+
+            # the settings kept from the previous config come with their
+            # territories and capacities
+            kept = bool(indexes) and locale in self.invalid
+            if kept:
+                self._keep_capacities(locale, indexes)
+                self._kept_keys = self._kept_keys + [
+                    key for index in indexes.values()
+                    for key in [index.default_key] +
+                    [test.key for test in index.tests.values()]]
+
+            with self._state_lock:
+                for key, index in indexes.items():
+                    index.set_saturated(self._saturated.get(key, ()))
+                if kept:
+                    self.territories[locale] = [territory for _, territory
+                                                in indexes]
+                self.locales.update(indexes)
+                del self._sources[locale]
+            if not self._sources:
+                self._reusable = {}
+                self._fallbacks = {}
+
+        if kept and self._on_capacities is not None:
+            self._on_capacities(self)
+        with self._activation_lock:
+            self._schedule()
+
+    def _keep_capacities(self, locale, indexes):
+        # the dicts are replaced, they may be read meanwhile
+        capacities = dict((key, size) for key, size in
+                          self.capacities.items() if key[0] != locale)
+        windows = dict((key, minutes) for key, minutes in
+                       self.windows.items() if key[0] != locale)
+        for index in indexes.values():
+            for test in index.tests.values():
+                if test.max_size:
+                    capacities[test.key] = test.max_size
+                    if test.window:
+                        windows[test.key] = test.window
+        self.capacities = capacities
+        self.windows = windows
+
+    def _valid_source(self, locale):
+        """Returns the name and data of a locale to compile: the ones of
+        the config if they're valid, else the ones of the previous config
+        if it did not compile them yet and they're valid.
+
+        The data is None when none is valid.
+        """
+        sources = [self._sources[locale]]
+        if locale in self._fallbacks:
+            sources.append(self._fallbacks.pop(locale))
+        if self._validate is None:
+            return sources[0]
+
+        for name, locale_data in sources:
+            try:
+                if (locale_data is sources[0][1] and
+                        locale in self._unreadable):
+                    raise ValueError('Invalid cohorts')
+                self._validate(name, locale_data)
+                return name, locale_data
+            except Exception:
+                logger.exception('Invalid locale %r' % name)
+                if locale not in self.invalid:
+                    self.invalid.append(locale)
+        return name, None
+
+    def _schedule(self):
+        self._pending = [index for index in self.locales.values()
+                         if index.next_activation is not None]
+        self.next_activation = min([index.next_activation
+                                    for index in self._pending] or [_NEVER])
+
+    def set_saturated(self, keys):
+        """Sets the (locale, territory, cohort) that reached their
+        maxSize.
+        """
+        cohorts = defaultdict(set)
+        for locale, territory, cohort in keys:
+            cohorts[locale, territory].add(cohort)
+        with self._state_lock:
+            self._saturated = dict((key, frozenset(names))
+                                   for key, names in cohorts.items())
+            for key, index in self.locales.items():
+                index.set_saturated(self._saturated.get(key, ()))
+
+    def saturate(self, locale, territory, cohort, full=True):
+        """Stops picking a cohort that reached its maxSize.
+
+        If full is False, the cohort can be picked again.
+        """
+        key = locale, territory
+        with self._state_lock:
+            cohorts = self._saturated.get(key, frozenset())
+            if full:
+                self._saturated[key] = cohorts | set([cohort])
+            else:
+                self._saturated[key] = cohorts - set([cohort])
+
+            index = self.locales.get(key)
+            if index is not None and cohort in index.tests:
+                index.saturate(cohort, full)
+
+    def saturated_cohorts(self):
+        return sorted((locale, territory, cohort)
+                      for (locale, territory), cohorts in
+                      self._saturated.items()
+                      for cohort in cohorts)
+
+    def response_sizes(self):
+        """Returns the total size of the responses of every compiled
+        locale, for every content coding.
+        """
+        sizes = {}
+        for (locale, territory), index in list(self.locales.items()):
+            totals = sizes.setdefault(locale, {})
+            for res in index.responses():
+                for encoding, size in res.sizes().items():
+                    totals[encoding] = totals.get(encoding, 0) + size
+        return sizes
+
+    def activate(self, now):
+        """Activates the tests whose startTime passed."""
+        # one thread does it, the others keep using the current tests
+        if not self._activation_lock.acquire(False):
+            return
+        try:
+            for index in self._pending:
+                if index.next_activation < now:
+                    index.activate(now)
+            self._schedule()
+            # the cohorts that started were cached as inactive
+            self.cohort_cache = LRUCache(self._cache_size, self._metrics,
+                                         'cohort_cache')
+        finally:
+            self._activation_lock.release()
+
+
 class SearchSettings(object):
 
     def __init__(self, config_reader, schema_reader=None, counter='memory',
-                 counter_options=None, max_age=None):
+                 counter_options=None, max_age=None,
+                 background_reload=False, clock=time.time, lazy=False,
+                 warm_locales=(), cohort_cache_size=1024):
         self.max_age = max_age
-        self.schema_md5 = self.config_md5 = None
+        self.cohort_cache_size = cohort_cache_size
+        # compiling the locales on first use, and warming some in the
+        # background
+        self.lazy = lazy
+        self.warm_locales = list(warm_locales)
+        self._warmer = None
+        self._clock = clock
+        self._snapshot = None
         self._last_loaded = None
+        self.metrics = Metrics()
+
+        # the validator compiled from the schema, keyed by its md5, and
+        # the ones checking the config and each locale in lazy mode
+        self._validator = None
+        self._validator_md5 = None
+        self._split_validators = None
+        self._validator_lock = threading.Lock()
 
-        logger.info("Use memory backend for counters")
-        counters_backend = MemoryCohortCounters
+        # one thread at a time reloads the files
+        self._load_lock = threading.Lock()
+        self._capacities_lock = threading.Lock()
+
+        if counter not in COUNTER_BACKENDS:
+            raise ValueError('Unknown counter backend %r' % counter)
+
+        logger.info("Use %s backend for counters" % counter)
+        counters_backend = COUNTER_BACKENDS[counter]
 
         if counter_options is None:
             counter_options = {}
 
-        self._counters = counters_backend(**counter_options)
+        self._counters = counters_backend(clock=clock, **counter_options)
 
         self.config_reader = config_reader
         self.schema_reader = schema_reader
         self.load()
 
+        self._background_reload = False
+        self._stopped = threading.Event()
+        self._reloader = None
+        if background_reload:
+            self.reload_in_background()
+
+    def reload_in_background(self):
+        """Reloads the files every max_age seconds in a background
+        thread, so requests never wait for it.
+        """
+        if self.max_age is None or self._reloader is not None:
+            return
+        self._background_reload = True
+        self._stopped = threading.Event()
+        self._reloader = threading.Thread(target=self._reload_loop,
+                                          name='absearch-reloader')
+        self._reloader.daemon = True
+        self._reloader.start()
+
+    @property
+    def config_md5(self):
+        return self._snapshot.config_md5
+
+    @property
+    def schema_md5(self):
+        return self._snapshot.schema_md5
+
+    def close(self):
+        """Stops the background reloading, if any, and the counters."""
+        self._stop_reloader()
+        self._counters.close()
+
+    def _stop_reloader(self):
+        self._stopped.set()
+        if self._reloader is not None:
+            self._reloader.join()
+            self._reloader = None
+
+    def before_fork(self):
+        """Stops the threads, which a forked process would not have."""
+        self._stop_reloader()
+        if self._warmer is not None:
+            self._warmer.join()
+            self._warmer = None
+        self._counters.before_fork()
+
+    def after_fork(self, worker=0):
+        """Prepares a forked worker process.
+
+        Workers don't reload the files: their parent does, and forks new
+        workers with the new settings.
+        """
+        self.max_age = None
+        self._background_reload = False
+        self._counters.after_fork(worker)
+
+    def worker_exited(self):
+        """Collects the counters of a worker of a previous generation,
+        once it exited.
+        """
+        self._counters.worker_exited()
+
+    def compile_all(self):
+        """Compiles the locales that were not compiled yet."""
+        self._snapshot.compile_all()
+
+    def _reload_loop(self):
+        while not self._stopped.wait(self.max_age):
+            try:
+                self.load()
+            except Exception:
+                # we keep the existing config
+                logger.exception('Could not reload the config')
+
+    def _changed(self, snapshot):
+        # readers that can't tell cheaply are always read again
+        for reader, md5 in ((self.config_reader, snapshot.config_md5),
+                            (self.schema_reader, snapshot.schema_md5)):
+            if reader is None:
+                continue
+            changed = getattr(reader, 'changed', None)
+            if changed is None or changed(md5):
+                return True
+        return False
+
+    def _get_validator(self, schema, schema_md5):
+        # called with the validator lock held
+        if self._validator is None or self._validator_md5 != schema_md5:
+            cls = validator_for(schema)
+            cls.check_schema(schema)
+            self._validator = cls(schema)
+            self._validator_md5 = schema_md5
+            self._split_validators = None
+        return self._validator
+
+    def _validate(self, config, schema, schema_md5):
+        # same as jsonschema.validate(), without creating and checking
+        # a validator every time
+        with self._validator_lock:
+            validator = self._get_validator(schema, schema_md5)
+
+            with self.metrics.timer('config.validate'):
+                error = best_match(validator.iter_errors(config))
+
+        if error is not None:
+            raise error
+
+    def _validate_lazily(self, config, schema, schema_md5):
+        """Validates the config but the content of its locales.
+
+        Returns the function validating a locale, for Snapshot.
+        """
+        with self._validator_lock:
+            validator = self._get_validator(schema, schema_md5)
+            if self._split_validators is None:
+                top, single = _split_schema(schema)
+                self._split_validators = (validator.evolve(schema=top),
+                                          validator.evolve(schema=single))
+            top, single = self._split_validators
+
+            with self.metrics.timer('config.validate'):
+                error = best_match(top.iter_errors(config))
+
+        if error is not None:
+            raise error
+
+        def validate_locale(name, data):
+            with self.metrics.timer('config.validate_locale'):
+                error = best_match(single.iter_errors({'locales':
+                                                       {name: data}}))
+            if error is not None:
+                raise error
+
+        return validate_locale
+
     def load(self):
         """Loads a configuration and builds internal indexes.
 
-        config is a dict.
+        The new indexes are built aside and replace the current ones
+        at once, so this can run while other threads call get().
+
+        When the config and the schema did not change, the current
+        indexes are kept. Returns True if they were rebuilt.
         """
-        schema = None
+        with self._load_lock:
+            with self.metrics.timer('config.reload'):
+                return self._load()
+
+    def _reload(self, now):
+        """Reloads the files, unless another thread is already doing it.
+
+        The callers that find a reload in progress don't wait for it and
+        keep using the current snapshot.
+        """
+        if not self._load_lock.acquire(False):
+            self.metrics.incr('config.reload.coalesced')
+            return False
+        try:
+            # another thread may have reloaded since we checked
+            if now - self._last_loaded <= self.max_age:
+                return False
+            with self.metrics.timer('config.reload'):
+                return self._load()
+        finally:
+            self._load_lock.release()
+
+    def _load(self):
+        current = self._snapshot
+        if current is not None and not self._changed(current):
+            self._last_loaded = self._clock()
+            return False
+
+        schema = schema_md5 = None
         try:
-            config, self.config_md5 = self.config_reader()
+            config, config_md5 = self.config_reader()
 
             if self.schema_reader:
-                schema, self.schema_md5 = self.schema_reader()
-            else:
-                self.schema_md5 = None
+                schema, schema_md5 = self.schema_reader()
         except ReadError:
             # if it's the first load we raise
-            if self._last_loaded is None:
+            if current is None:
                 raise
             else:
                 # otherwise we keep the existing config
                 # but we tell ops about the incident
                 # XXX tell something to ops
-                return
+                return False
 
+        if (current is not None and config_md5 == current.config_md5 and
+                schema_md5 == current.schema_md5):
+            # same content, no need to validate and index it again
+            self._last_loaded = self._clock()
+            return False
+
+        validate_locale = None
         if schema is not None:
-            validate(config, schema)
-
-        self._default_interval = config.get('defaultInterval',
-                                            DEFAULT_INTERVAL)
-        self._excluded = set(config['excludedDistributionIDPrefixes'])
-        self._locales = {}
-        self._territories = defaultdict(list)
-
-        for locale, locale_data in config['locales'].items():
-            locale = _lower(locale)
-
-            # building indexes
-            for territory, data in locale_data.items():
-                territory = _lower(territory)
-
-                tests = {}
-                if territory == 'default':
-                    # fallback territory
-                    default = data
-                else:
-                    # default settings
-                    default = data['default']
-
-                    # converting filters
-                    for name, test in data.get('tests', {}).items():
-                        filters = test['filters']
-                        filters['products'] = [_lower(p) for p in
-                                               filters.get('products', [])]
-                        filters['channels'] = [_lower(c) for c in
-                                               filters.get('channels', [])]
-                        # Use a very small version
-                        filters['minVersion'] = filters.get('minVersion',
-                                                            '0.1')
-                        # Use a very large version
-                        filters['maxVersion'] = filters.get('maxVersion',
-                                                            '1000.0')
-                        tests[name] = test
-
-                self._locales[locale, territory] = default, tests
-                self._territories[locale].append(territory)
-
-        self._last_loaded = time.time()
+            if self.lazy:
+                validate_locale = self._validate_lazily(config, schema,
+                                                        schema_md5)
+            else:
+                self._validate(config, schema, schema_md5)
+
+        now = self._clock()
+        snapshot = Snapshot(config, config_md5, schema_md5, now, current,
+                            lazy=self.lazy, validate=validate_locale,
+                            clock=self._clock, metrics=self.metrics,
+                            cache_size=self.cohort_cache_size,
+                            on_capacities=self._set_capacities)
+        # the snapshot is used once the counters accepted it
+        self._counters.set_slots(snapshot.slots, config_md5)
+        with self._capacities_lock:
+            self._counters.set_capacities(snapshot.capacities,
+                                          self._on_capacity,
+                                          snapshot.windows)
+            self._snapshot = snapshot
+            # with the events of the cohorts that filled meanwhile
+            snapshot.set_saturated(self._counters.saturated())
+        self._last_loaded = now
+
+        if self.lazy and self.warm_locales:
+            self._warmer = threading.Thread(target=self._warm,
+                                            args=(snapshot,),
+                                            name='absearch-warmer')
+            self._warmer.daemon = True
+            self._warmer.start()
+        return True
+
+    def _set_capacities(self, snapshot):
+        # the counters tell us when a cohort fills up, so requests
+        # don't need to check them
+        with self._capacities_lock:
+            if snapshot is not self._snapshot:
+                return
+            full = self._counters.set_capacities(snapshot.capacities,
+                                                 self._on_capacity,
+                                                 snapshot.windows)
+            snapshot.set_saturated(full)
+
+    def _warm(self, snapshot):
+        # compiles the locales we know will be asked for
+        for locale in self.warm_locales:
+            try:
+                snapshot.compile(_lower(locale))
+            except Exception:
+                logger.exception('Could not compile %r' % locale)
+
+    def _on_capacity(self, locale, territory, cohort, full):
+        if full:
+            logger.info('Cohort %s is full' % '.'.join((locale, territory,
+                                                        cohort)))
+        self._snapshot.saturate(locale, territory, cohort, full)
+
+    def saturated_cohorts(self):
+        """Returns the (locale, territory, cohort) of the tests that
+        reached their maxSize.
+        """
+        return self._snapshot.saturated_cohorts()
+
+    def invalid_locales(self):
+        """Returns the locales that could not be validated, and whose
+        previous settings are served, if any.
+        """
+        return sorted(self._snapshot.invalid)
+
+    def response_sizes(self):
+        """Returns the total size of the responses of every locale, by
+        content coding: identity, gzip and maybe br.
+        """
+        return self._snapshot.response_sizes()
 
     def get(self, prod, ver, channel, locale, territory, dist, distver,
             cohort=None):
@@ -138,12 +747,123 @@ class SearchSettings(object):
         If no match is found, raises a KeyError.
 
         If cohort is None, randomly picks a cohort.
+
+        The returned settings are shared and read-only.
         """
-        # reload the files if needed
-        if (self.max_age is not None and
-                time.time() - self._last_loaded > self.max_age):
-            self.load()
+        snapshot = self._current()
+
+        # the settings of a cohort only change with the snapshot
+        if cohort is not None:
+            cache = snapshot.cohort_cache
+            request = (prod, ver, channel, locale, territory, dist, distver,
+                       cohort)
+            res = cache.get(request)
+            if res is None:
+                res = self._evaluate(snapshot, prod, ver, channel, locale,
+                                     territory, dist, cohort)
+                cache.put(request, res)
+            return res
+
+        index, prod, channel = self._route(snapshot, prod, ver, channel,
+                                           locale, territory, dist)
+        if index is None:
+            return snapshot.interval_response
+
+        # pick one
+        return self._pick_cohort(index, prod, ver, channel)
+
+    def evaluate(self, prod, ver, channel, locale, territory, dist, distver,
+                 cohort=None):
+        """Like get(), but without counting the pick.
+
+        Used by health checks and tools, so they don't change the
+        cohort sizes.
+        """
+        return self._evaluate(self._current(), prod, ver, channel, locale,
+                              territory, dist, cohort)
+
+    def _evaluate(self, snapshot, prod, ver, channel, locale, territory,
+                  dist, cohort):
+        index, prod, channel = self._route(snapshot, prod, ver, channel,
+                                           locale, territory, dist)
+        if index is None:
+            return snapshot.interval_response
+        if cohort is not None:
+            return self._get_cohort(index, cohort)
+        test = self._choose(index, prod, ver, channel)
+        return index.default if test is None else test.response
+
+    def explain(self, prod, ver, channel, locale, territory, dist, distver,
+                cohort=None):
+        """Tells how a request is resolved, without counting it.
+
+        Returns a dict with the response that evaluate() would return,
+        the (locale, territory) serving it, and why each of their tests
+        can or can't be picked. The candidates are mapped to their
+        chance of being picked, in percents, and so is the default.
+        """
+        snapshot = self._current()
+        index, prod, channel = self._route(snapshot, prod, ver, channel,
+                                           locale, territory, dist)
+        if index is None:
+            if snapshot.excluded.matches(_lower(dist)):
+                reason = 'excluded distribution'
+            else:
+                reason = 'unknown locale'
+            return {'response': snapshot.interval_response,
+                    'reason': reason}
+
+        explanation = {'locale': index.locale,
+                       'territory': index.territory}
+        if cohort is not None:
+            response = self._get_cohort(index, cohort)
+            explanation['response'] = response
+            if 'cohort' in response:
+                explanation['reason'] = 'requested cohort'
+            else:
+                explanation['reason'] = 'inactive cohort'
+            return explanation
+
+        version = parse_version(str(ver))
+        tests = index.candidates(prod, channel, version)
+        weights, default = cohort_weights(tests)
+        test = index.sampler(tests).pick()
+        explanation['response'] = (index.default if test is None
+                                   else test.response)
+        explanation['reason'] = 'picked'
+        explanation['tests'] = index.explain(prod, channel, version)
+        explanation['candidates'] = dict((test.name, weight)
+                                         for test, weight in
+                                         zip(tests, weights))
+        explanation['default'] = default
+        return explanation
+
+    def _current(self):
+        """Returns the snapshot serving a request, once the files are
+        reloaded and the tests activated if needed.
+        """
+        now = self._clock()
 
+        # reload the files if needed
+        if (self.max_age is not None and not self._background_reload and
+                now - self._last_loaded > self.max_age):
+            self._reload(now)
+
+        # the whole request is served by the same snapshot
+        snapshot = self._snapshot
+        if now > snapshot.next_activation:
+            snapshot.activate(now)
+        # windowed cohorts may not be full anymore
+        if now >= self._counters.next_expiry:
+            self._counters.expire()
+        return snapshot
+
+    def _route(self, snapshot, prod, ver, channel, locale, territory, dist):
+        """Finds the (locale, territory) serving a request.
+
+        Returns the index or None when the interval is to be sent back,
+        and the lowered product and channel.
+        """
         # we should do this at the http level
         locale = _lower(locale)
         territory = _lower(territory)
@@ -157,129 +877,49 @@ class SearchSettings(object):
         # Allow for prerelease channels (release-localtest, beta-cdntest)
         channel = _REMOVE_PRERELEASE_SUFFIX.sub('', channel)
         dist = _lower(dist)
-        distver = _lower(distver)
 
         # if dist is part of the excluded list, we're sending back
         # the global interval value
-        for excluded in self._excluded:
-            if dist.startswith(excluded):
-                return {'interval': self._default_interval}
+        if snapshot.excluded.matches(dist):
+            return None, prod, channel
 
         # if the provided territory is not listed in that locale,
         # switch it to default
-        if locale not in self._territories and '-' in locale:
-            if locale.split('-')[0] in self._territories:
+        if locale not in snapshot.territories and '-' in locale:
+            if locale.split('-')[0] in snapshot.territories:
                 locale = locale.split('-')[0]
 
-        if territory not in self._territories[locale]:
+        # the territories of a locale kept from the previous config are
+        # known once it's compiled
+        snapshot.compile(locale)
+        if territory not in snapshot.territories.get(locale, ()):
             territory = 'default'
 
         # if we don't have that, send back an interval
-        if (locale, territory) not in self._locales:
-            return {'interval': self._default_interval}
-
-        # we got something!
-        if cohort is not None:
-            res, picked_cohort = self._get_cohort(locale, territory, cohort)
-            if picked_cohort != 'default':
-                res['cohort'] = picked_cohort
-        else:
-            # pick one
-            res = self._pick_cohort(locale, territory, prod, ver, channel)
-
-        if 'interval' not in res:
-            res['interval'] = self._default_interval
-
-        allowed_keys = ('cohort', 'settings', 'interval')
-        res = copy.deepcopy(res)
-
-        for key in list(res.keys()):
-            if key not in allowed_keys:
-                del res[key]
-
-        return res
-
-    def _get_cohort(self, locale, territory, cohort):
-        default, tests = self._locales[locale, territory]
-
-        if cohort not in tests:
-            # we send back a copy of the default settings
-            return copy.deepcopy(default), 'default'
-
-        # we send back the cohort settings if the cohort is active
-        cohort_data = tests[cohort]
-        start_time = cohort_data['filters'].get('startTime')
-        if start_time and start_time >= time.time():
-            # not active yet
-            # we send back a copy of the default settings
-            return copy.deepcopy(default), 'default'
-
-        # we send back a copy of the cohort settings
-        return copy.deepcopy(cohort_data), cohort
-
-    def _is_filtered(self, prod, ver, channel, locale, territory, cohort,
-                     filters):
-        start_time = filters.get('startTime')
-        if start_time and start_time >= time.time():
-            # not active yet
-            return True
+        index = snapshot.index(locale, territory)
+        return index, prod, channel
 
-        if len(filters['products']) > 0 and prod not in filters['products']:
-            return True
+    def _get_cohort(self, index, cohort):
+        # we send back the cohort settings if the cohort is active,
+        # the default settings otherwise
+        return index.response(cohort)
 
-        if len(filters['channels']) > 0 and channel not in filters['channels']:
-            return True
+    def _choose(self, index, prod, ver, channel):
+        # returns the picked test, or None for the default
+        if not index.tests:
+            return None
 
-        if LooseVersion(str(ver)) < LooseVersion(str(filters['minVersion'])):
-            return True
+        # tests that are full or not started yet are not candidates
+        tests = index.candidates(prod, channel, parse_version(str(ver)))
 
-        if LooseVersion(str(ver)) > LooseVersion(str(filters['maxVersion'])):
-            return True
-
-        max = filters.get('maxSize')
-        if max:
-            current = self._counters.get(locale, territory, cohort)
-            if current >= max:
-                return True
-
-        # all good
-        return False
-
-    def _pick_cohort(self, locale, territory, prod, ver, channel):
-        default, tests = self._locales[locale, territory]
-
-        if tests == {}:
-            self._counters.incr(locale, territory, 'default')
-            return copy.deepcopy(default)
-
-        # building a list of filtered cohorts with their weights
-        total_weight = 0
-        cohorts = []
-
-        for cohort, info in tests.items():
-            filters = info['filters']
-            if self._is_filtered(prod, ver, channel, locale, territory,
-                                 cohort, filters):
-                continue
-
-            weight = filters['sampleRate']
-            cohorts.append((cohort, weight))
-            total_weight += weight
+        # now let's pick one
+        return index.sampler(tests).pick()
 
-        # adding default
-        cohorts.append(('default', 100 - total_weight))
+    def _pick_cohort(self, index, prod, ver, channel):
+        test = self._choose(index, prod, ver, channel)
+        if test is None:
+            self._counters.incr_slot(index.default_slot, index.default_key)
+            return index.default
 
-        # now let's pick one
-        choices, weights = zip(*cohorts)
-        cumdist = list(accumulate(weights))
-        x = random.random() * 100
-        picked = choices[bisect.bisect(cumdist, x)]
-        self._counters.incr(locale, territory, picked)
-
-        # and send it back
-        if picked == 'default':
-            return copy.deepcopy(default)
-
-        settings = copy.deepcopy(tests[picked])
-        settings['cohort'] = picked
-        return settings
+        self._counters.incr_slot(test.slot, test.key)
+        return test.response
@@ -1,5 +1,8 @@
 import os
+import socket
+import socketserver
 import sys
+import threading
 from io import StringIO
 from contextlib import contextmanager
 
@@ -30,3 +33,79 @@ def capture():
         sys.stdout, sys.stderr = oldout, olderr
         out[0] = out[0].getvalue()
         out[1] = out[1].getvalue()
+
+
+class FakeRedis(socketserver.ThreadingTCPServer):
+    """A Redis server knowing INCRBY, GET, PING, AUTH and SELECT."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port=0):
+        self.data = {}
+        self.commands = []
+        # the names of the commands answered with an error
+        self.failing = set()
+        self.connections = []
+        self.lock = threading.Lock()
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', port),
+                                                 _RedisHandler)
+        self.port = self.server_address[1]
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        for connection in self.connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self._thread.join()
+
+
+class _RedisHandler(socketserver.StreamRequestHandler):
+
+    def _read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for i in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2].decode('utf8'))
+        return args
+
+    def handle(self):
+        server = self.server
+        server.connections.append(self.connection)
+        while True:
+            try:
+                command = self._read_command()
+            except OSError:
+                return
+            if command is None:
+                return
+            name = command[0].upper()
+            with server.lock:
+                server.commands.append(command)
+                if name in server.failing:
+                    reply = b'-ERR failing\r\n'
+                elif name == 'INCRBY':
+                    value = server.data.get(command[1], 0) + int(command[2])
+                    server.data[command[1]] = value
+                    reply = b':%d\r\n' % value
+                elif name == 'GET':
+                    value = server.data.get(command[1])
+                    if value is None:
+                        reply = b'$-1\r\n'
+                    else:
+                        value = str(value).encode('utf8')
+                        reply = b'$%d\r\n%s\r\n' % (len(value), value)
+                elif name in ('PING', 'AUTH', 'SELECT'):
+                    reply = b'+OK\r\n'
+                else:
+                    reply = b'-ERR unknown command\r\n'
+            self.wfile.write(reply)
@@ -0,0 +1,145 @@
+import asyncio
+import json
+import socket
+import threading
+from contextlib import contextmanager
+
+from absearch import server
+from absearch.aioserver import AsyncServer, serve
+from absearch.tests.support import test_config
+
+
+@contextmanager
+def running(**kw):
+    server.initialize_app(test_config)
+    loop = asyncio.new_event_loop()
+    front = AsyncServer(server.app.settings, loop=loop, **kw)
+    listener = loop.run_until_complete(front.start('127.0.0.1', 0))
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+    try:
+        yield front, listener.sockets[0].getsockname()[1]
+    finally:
+        loop.call_soon_threadsafe(front.close)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        # letting the sweeper see it's cancelled
+        loop.run_until_complete(asyncio.sleep(0))
+        loop.close()
+
+
+def read_response(f):
+    status = int(f.readline().split()[1])
+    headers = {}
+    while True:
+        line = f.readline().decode('latin-1').strip()
+        if not line:
+            break
+        name, value = line.split(':', 1)
+        headers[name.lower()] = value.strip()
+    body = f.read(int(headers['content-length']))
+    return status, headers, body
+
+
+def request(path, headers=''):
+    return ('GET %s HTTP/1.1\r\nHost: localhost\r\n%s\r\n' % (
+        path, headers)).encode('latin-1')
+
+
+def test_keep_alive_and_pipelining():
+    path = '/1/firefox/39/beta/en-US/US/default/default'
+    with running() as (front, port):
+        with socket.create_connection(('127.0.0.1', port)) as sock:
+            f = sock.makefile('rb')
+            # two pipelined requests, then another on the same connection
+            sock.sendall(request(path) + request('/__heartbeat__'))
+            status, headers, body = read_response(f)
+            assert status == 200
+            assert headers['content-type'] == 'application/json'
+            assert headers['cache-control'] == 'max-age=300'
+            assert json.loads(body.decode('utf8'))['interval'] == 31536000
+            etag = headers['etag']
+
+            status, headers, body = read_response(f)
+            assert status == 200
+            assert 'config_md5' in json.loads(body.decode('utf8'))
+
+            sock.sendall(request(path, 'If-None-Match: %s\r\n' % etag))
+            status, headers, body = read_response(f)
+            assert status == 304
+            assert body == b''
+
+            sock.sendall(request('/1/firefox/bad/beta/en-US/US/default/'
+                                 'default', 'Connection: close\r\n'))
+            status, headers, body = read_response(f)
+            assert status == 404
+            assert headers['connection'] == 'close'
+            assert f.read() == b''
+
+
+def test_bad_requests():
+    with running() as (front, port):
+        with socket.create_connection(('127.0.0.1', port)) as sock:
+            sock.sendall(b'nope\r\n\r\n')
+            f = sock.makefile('rb')
+            assert read_response(f)[0] == 400
+            assert f.read() == b''
+
+        with socket.create_connection(('127.0.0.1', port)) as sock:
+            sock.sendall(b'POST / HTTP/1.1\r\nContent-Length: 2\r\n\r\nhi')
+            assert read_response(sock.makefile('rb'))[0] == 405
+
+        # a body is dropped as it comes, and the next request answered
+        with socket.create_connection(('127.0.0.1', port)) as sock:
+            f = sock.makefile('rb')
+            sock.sendall(b'POST / HTTP/1.1\r\nContent-Length: 10\r\n\r\n'
+                         b'01234')
+            sock.sendall(b'56789' + request('/__lbheartbeat__'))
+            assert read_response(f)[0] == 405
+            assert read_response(f)[0] == 200
+            assert not any(protocol._buffer
+                           for protocol in list(front.connections))
+
+        # bodies are bounded
+        with socket.create_connection(('127.0.0.1', port)) as sock:
+            sock.sendall(b'POST / HTTP/1.1\r\n'
+                         b'Content-Length: 100000000000\r\n\r\n')
+            f = sock.makefile('rb')
+            assert read_response(f)[0] == 413
+            assert f.read() == b''
+
+
+def test_max_connections():
+    with running(max_connections=1) as (front, port):
+        with socket.create_connection(('127.0.0.1', port)) as first:
+            first.sendall(request('/__lbheartbeat__'))
+            assert read_response(first.makefile('rb'))[0] == 200
+
+            with socket.create_connection(('127.0.0.1', port)) as second:
+                try:
+                    second.sendall(request('/__lbheartbeat__'))
+                    assert second.makefile('rb').read() == b''
+                except ConnectionResetError:
+                    pass
+        assert front.metrics.get('aioserver.rejected') == 1
+
+
+def test_serve_reloads_in_background():
+    server.initialize_app(test_config)
+    settings = server.app.settings
+    assert settings._reloader is None
+    loop = asyncio.new_event_loop()
+    try:
+        task = loop.create_task(serve(settings, '127.0.0.1', 0))
+        loop.run_until_complete(asyncio.sleep(.05))
+        # the requests served in the loop never reload the files
+        assert settings._reloader is not None
+        assert settings._background_reload
+        task.cancel()
+        try:
+            loop.run_until_complete(task)
+        except asyncio.CancelledError:
+            pass
+    finally:
+        loop.close()
+        settings.close()
@@ -0,0 +1,26 @@
+from absearch.cache import LRUCache
+from absearch.metrics import Metrics
+
+
+def test_lru():
+    metrics = Metrics()
+    cache = LRUCache(2, metrics, 'test')
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+
+    # b was the least recently used
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+    assert metrics.snapshot()['counters'] == {'test.hits': 2,
+                                              'test.misses': 1,
+                                              'test.evictions': 1}
+
+
+def test_disabled():
+    cache = LRUCache(0)
+    cache.put('a', 1)
+    assert cache.get('a', 'default') == 'default'
+    assert len(cache) == 0
@@ -1,3 +1,4 @@
+import json
 import os
 import shutil
 
@@ -52,3 +53,18 @@ def test_check_enum_fails():
 
     # we should fail
     assert e is not None
+
+
+def test_check_explain():
+    with capture() as out:
+        res = main(['--explain', 'firefox/39/beta/fr-FR/FR/default/default'])
+
+    stdout, stderr = out
+    assert res == 0
+    explanation = json.loads(stdout.split('OK\n', 1)[1])
+    assert explanation['locale'] == 'fr-fr'
+    assert explanation['candidates'] == {'fooBaz': 100}
+
+    with capture() as out:
+        res = main(['--explain', 'firefox/39'])
+    assert res == 1
@@ -1,4 +1,14 @@
-from absearch.counters import MemoryCohortCounters
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+
+import pytest
+
+from absearch.counters import (MemoryCohortCounters, SharedCohortCounters,
+                               Window)
 
 
 def test_memory():
@@ -10,3 +20,350 @@ def test_memory():
 
     value = counter.get('en-US', 'US', 'abc')
     assert value == 9, value
+
+
+def test_capacity_events():
+    counter = MemoryCohortCounters()
+    counter.incr('en-US', 'US', 'abc')
+    events = []
+
+    def listener(*args):
+        events.append(args)
+
+    full = counter.set_capacities({('en-US', 'US', 'abc'): 1,
+                                   ('en-US', 'US', 'def'): 2}, listener)
+    assert full == set([('en-US', 'US', 'abc')])
+
+    counter.incr('en-US', 'US', 'def')
+    assert events == []
+    counter.incr('en-US', 'US', 'def')
+    counter.incr('en-US', 'US', 'def')
+    assert events == [('en-US', 'US', 'def', True)]
+    assert counter.saturated() == [('en-US', 'US', 'abc'),
+                                   ('en-US', 'US', 'def')]
+
+    counter.decr('en-US', 'US', 'abc')
+    assert events[-1] == ('en-US', 'US', 'abc', False)
+    assert counter.saturated() == [('en-US', 'US', 'def')]
+
+
+def test_memory_threads():
+    counter = MemoryCohortCounters(stripes=2)
+    interval = sys.getswitchinterval()
+    # switching threads as often as possible
+    sys.setswitchinterval(1e-6)
+
+    def incr():
+        for i in range(2000):
+            counter.incr('en-US', 'US', 'abc')
+            counter.incr('en-US', 'US', str(i % 3))
+
+    try:
+        threads = [threading.Thread(target=incr) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+
+    assert counter.get('en-US', 'US', 'abc') == 16000
+    total = sum(counter.get('en-US', 'US', str(i)) for i in range(3))
+    assert total == 16000
+
+
+def test_shared_processes():
+    testdir = tempfile.mkdtemp()
+    path = os.path.join(testdir, 'counters')
+    keys = [('en-us', 'us', 'abc'), ('en-us', 'us', 'default')]
+    try:
+        counter = SharedCohortCounters(path)
+        counter.set_slots(keys)
+        counter.incr('en-us', 'us', 'abc')
+
+        def incr():
+            # each process maps the file on its own
+            other = SharedCohortCounters(path)
+            other.set_slots(keys)
+            for i in range(500):
+                other.incr('en-us', 'us', 'abc')
+
+        context = multiprocessing.get_context('fork')
+        processes = [context.Process(target=incr) for i in range(4)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        assert counter.get('en-us', 'us', 'abc') == 2001
+
+        # values are kept by a new layout
+        counter.set_slots([('en-us', 'us', 'abc'), ('fr', 'fr', 'default')])
+        assert counter.get('en-us', 'us', 'abc') == 2001
+        assert len(os.listdir(testdir)) == 1
+
+        # keys without a slot are local
+        counter.incr('de', 'de', 'default')
+        assert counter.get('de', 'de', 'default') == 1
+    finally:
+        shutil.rmtree(testdir)
+
+
+def test_shared_layout_switch():
+    testdir = tempfile.mkdtemp()
+    path = os.path.join(testdir, 'counters')
+    keys = [('en-us', 'us', 'abc'), ('en-us', 'us', 'default')]
+    new_keys = keys + [('fr', 'fr', 'default')]
+    try:
+        # two processes, mapping the file on their own
+        first = SharedCohortCounters(path)
+        second = SharedCohortCounters(path)
+        first.set_slots(keys)
+        second.set_slots(keys)
+        first.incr('en-us', 'us', 'abc')
+        second.incr('en-us', 'us', 'abc')
+
+        # the first one to reload brings the values
+        first.set_slots(new_keys)
+        assert first.get('en-us', 'us', 'abc') == 2
+
+        # what the second one counts before reloading is not lost
+        second.incr('en-us', 'us', 'abc')
+        second.incr('en-us', 'us', 'abc')
+        first.incr('en-us', 'us', 'abc')
+        second.set_slots(new_keys)
+        assert first.get('en-us', 'us', 'abc') == 5
+        assert second.get('en-us', 'us', 'abc') == 5
+
+        # nor counted twice by a third process switching late
+        third = SharedCohortCounters(path)
+        third.set_slots(new_keys)
+        assert third.get('en-us', 'us', 'abc') == 5
+        assert len(os.listdir(testdir)) == 1
+    finally:
+        shutil.rmtree(testdir)
+
+
+def test_shared_worker_switch():
+    keys = [('en-us', 'us', 'abc'), ('en-us', 'us', 'default')]
+    new_keys = keys + [('fr', 'fr', 'default')]
+    counter = SharedCohortCounters()
+    try:
+        counter.set_slots(keys)
+        counter.incr('en-us', 'us', 'abc')
+        counter.before_fork()
+        context = multiprocessing.get_context('fork')
+        switched = context.Event()
+
+        def work():
+            # a worker of the old generation keeps its layout
+            counter.after_fork()
+            switched.wait(10)
+            for i in range(10):
+                counter.incr('en-us', 'us', 'abc')
+
+        worker = context.Process(target=work)
+        worker.start()
+
+        # the parent reloads while the worker counts
+        counter.set_slots(new_keys)
+        switched.set()
+        worker.join()
+        assert counter.get('en-us', 'us', 'abc') == 1
+
+        # and collects what it counted once it exited, once
+        counter.worker_exited()
+        assert counter.get('en-us', 'us', 'abc') == 11
+        counter.worker_exited()
+        assert counter.get('en-us', 'us', 'abc') == 11
+    finally:
+        counter.close()
+
+
+def test_shared_files():
+    testdir = tempfile.mkdtemp()
+    keys = [('en-us', 'us', 'abc')]
+    try:
+        # a link put in place of a counters file is not followed
+        path = os.path.join(testdir, 'counters')
+        target = os.path.join(testdir, 'target')
+        counter = SharedCohortCounters(path)
+        counter.set_slots(keys)
+        filename = counter._filename
+        os.remove(filename)
+        os.symlink(target, filename)
+        other = SharedCohortCounters(path)
+        with pytest.raises(OSError):
+            other.set_slots(keys)
+        assert not os.path.exists(target)
+    finally:
+        shutil.rmtree(testdir)
+
+    # without a path, the files are in a private directory, removed on
+    # close
+    counter = SharedCohortCounters()
+    counter.set_slots(keys)
+    directory = os.path.dirname(counter._filename)
+    assert os.stat(directory).st_mode & 0o777 == 0o700
+    assert os.stat(counter._filename).st_mode & 0o777 == 0o600
+    counter.close()
+    assert not os.path.exists(directory)
+
+
+def test_memory_slots():
+    counter = MemoryCohortCounters()
+    counter.incr('en-us', 'us', 'abc')
+
+    keys = [('en-us', 'us', 'abc'), ('en-us', 'us', 'default')]
+    counter.set_slots(keys)
+    assert counter.slot('en-us', 'us', 'abc') == 0
+    assert counter.get('en-us', 'us', 'abc') == 1
+
+    counter.incr_slot(0, keys[0])
+    counter.incr_slot(1, keys[1])
+    assert counter.get('en-us', 'us', 'abc') == 2
+    assert counter.get('en-us', 'us', 'default') == 1
+
+    # values are kept for the keys that still exist
+    keys = [('de', 'de', 'default'), ('en-us', 'us', 'abc')]
+    counter.set_slots(keys)
+    assert counter.get('en-us', 'us', 'abc') == 2
+    assert counter.slot('en-us', 'us', 'default') is None
+
+    # a slot from an older layout is checked against its key
+    counter.incr_slot(0, ('en-us', 'us', 'abc'))
+    assert counter.get('en-us', 'us', 'abc') == 3
+    assert counter.get('de', 'de', 'default') == 0
+
+
+def test_memory_checkpoint():
+    testdir = tempfile.mkdtemp()
+    checkpoint = os.path.join(testdir, 'counters.json')
+    keys = [('en-us', 'us', 'abc'), ('en-us', 'us', 'default')]
+    try:
+        counter = MemoryCohortCounters(checkpoint=checkpoint,
+                                       checkpoint_interval=0)
+        counter.set_slots(keys, 'md5')
+        counter.incr('en-us', 'us', 'abc')
+        counter.incr('en-us', 'us', 'abc')
+        assert counter.save()
+        # nothing changed
+        assert not counter.save()
+        counter.incr('en-us', 'us', 'default')
+        counter.close()
+        assert os.listdir(testdir) == ['counters.json']
+
+        # a restart with the same config gets the counters back
+        counter = MemoryCohortCounters(checkpoint=checkpoint,
+                                       checkpoint_interval=0)
+        counter.set_slots(keys, 'md5')
+        assert counter.get('en-us', 'us', 'abc') == 2
+        assert counter.get('en-us', 'us', 'default') == 1
+        full = counter.set_capacities({('en-us', 'us', 'abc'): 2})
+        assert full == set([('en-us', 'us', 'abc')])
+
+        # later layouts don't read it again
+        counter.set_slots(keys, 'md5')
+        assert counter.get('en-us', 'us', 'abc') == 2
+
+        # another config gets the counters of the cohorts it kept
+        counter = MemoryCohortCounters(checkpoint=checkpoint,
+                                       checkpoint_interval=0)
+        counter.set_slots([('en-us', 'us', 'abc'), ('fr', 'fr', 'default')],
+                          'other')
+        assert counter.get('en-us', 'us', 'abc') == 2
+        assert counter.get('en-us', 'us', 'default') == 0
+        assert counter.get('fr', 'fr', 'default') == 0
+    finally:
+        shutil.rmtree(testdir)
+
+
+def test_window():
+    window = Window(3)
+    assert window.add(10, 2) == 2
+    assert window.add(11, 1) == 3
+    assert window.add(12, 1) == 4
+    # the enrollments of minute 10 expire
+    assert window.advance(13) == 2
+    assert window.add(13, 5) == 7
+    assert window.advance(20) == 0
+    assert list(window.buckets) == [0, 0, 0]
+
+
+def test_windowed_capacity():
+    now = [600.]
+    counter = MemoryCohortCounters(clock=lambda: now[0])
+    key = ('en-us', 'us', 'abc')
+    counter.set_slots([key])
+    events = []
+
+    def listener(*args):
+        events.append(args)
+
+    # 2 enrollments per 3 minutes
+    full = counter.set_capacities({key: 2}, listener, {key: 3})
+    assert full == set()
+    assert counter.next_expiry == float('inf')
+
+    counter.incr(*key)
+    now[0] += 60
+    counter.incr(*key)
+    assert events == [('en-us', 'us', 'abc', True)]
+    assert counter.next_expiry == 720
+
+    # the first enrollment leaves the window
+    now[0] = 720
+    counter.expire()
+    assert counter.next_expiry == 780
+    now[0] = 780
+    counter.expire()
+    assert events[-1] == ('en-us', 'us', 'abc', False)
+    assert counter.next_expiry == float('inf')
+    # the lifetime counter keeps growing
+    assert counter.get(*key) == 2
+
+    # windows survive a reload
+    counter.incr(*key)
+    counter.set_slots([key])
+    assert counter.set_capacities({key: 2}, listener, {key: 3}) == set([key])
+
+
+def test_memory_fork_handoff():
+    keys = [('en-us', 'us', 'abc'), ('en-us', 'us', 'default')]
+    counter = MemoryCohortCounters(checkpoint_interval=0)
+    counter.set_slots(keys, 'md5')
+
+    def fork(check):
+        pid = os.fork()
+        if pid == 0:
+            # a worker
+            code = 1
+            try:
+                counter.after_fork(0)
+                if check():
+                    code = 0
+                counter.close()
+            finally:
+                os._exit(code)
+        return os.waitpid(pid, 0)[1] == 0
+
+    try:
+        counter.before_fork()
+        assert counter.checkpoint is not None
+
+        def count():
+            counter.incr('en-us', 'us', 'abc')
+            counter.incr('en-us', 'us', 'abc')
+            return True
+
+        assert fork(count)
+
+        # the next worker of that number, forked with a new config,
+        # goes on with its counters
+        counter.set_slots(keys + [('fr', 'fr', 'default')], 'md5-2')
+        counter.before_fork()
+        assert fork(lambda: counter.get('en-us', 'us', 'abc') == 2)
+    finally:
+        handoff = counter._handoff
+        counter.close()
+    assert not os.path.exists(handoff)
@@ -0,0 +1,125 @@
+from collections import Counter
+
+from absearch.index import (accumulate, AliasTable, cohort_weights,
+                            parse_version, PrefixMatcher, TerritoryIndex,
+                            VersionIndex)
+
+
+def _test(sample_rate=1, **filters):
+    filters['sampleRate'] = sample_rate
+    return {'settings': {}, 'filters': filters}
+
+
+def test_parse_version():
+    assert parse_version('39') < parse_version('39.1')
+    assert parse_version('39.1') < parse_version('39.2')
+    assert parse_version('39.10') > parse_version('39.9')
+    assert parse_version('45.0a1') < parse_version('45.4')
+    assert parse_version('39.2') == parse_version(str(39.2))
+
+    # numbers sort before strings instead of raising a TypeError
+    assert parse_version('45.4') < parse_version('45.a')
+
+
+def test_version_index():
+    index = TerritoryIndex('fr', 'fr', {}, {
+        'low': _test(minVersion=39.2, maxVersion=45.4),
+        'high': _test(minVersion=45.4),
+        'all': _test(),
+    }, 3600)
+    buckets = VersionIndex(list(index.tests.values()))
+
+    def names(ver):
+        return sorted(test.name for test in
+                      buckets.lookup(parse_version(ver)))
+
+    assert names('0.0.1') == []
+    assert names('39.1') == ['all']
+    assert names('39.2') == ['all', 'low']
+    assert names('40') == ['all', 'low']
+    assert names('45.4') == ['all', 'high', 'low']
+    assert names('45.5') == ['all', 'high']
+    assert names('1000') == ['all', 'high']
+    assert names('1001') == []
+
+
+def test_territory_index_buckets():
+    index = TerritoryIndex('fr', 'fr', {}, {
+        'ff': _test(products=['Firefox']),
+        'beta': _test(channels=['beta', 'release']),
+        'ffbeta': _test(products=['firefox'], channels=['beta']),
+        'all': _test(),
+    }, 3600)
+
+    def names(prod, channel):
+        return sorted(test.name for test in
+                      index.candidates(prod, channel, parse_version('40')))
+
+    assert names('firefox', 'beta') == ['all', 'beta', 'ff', 'ffbeta']
+    assert names('firefox', 'release') == ['all', 'beta', 'ff']
+    assert names('firefox', 'nightly') == ['all', 'ff']
+    assert names('thunderbird', 'beta') == ['all', 'beta']
+    assert names('thunderbird', 'alpha') == ['all']
+
+    # the order of the config is kept
+    order = [test.name for test in
+             index.candidates('firefox', 'beta', parse_version('40'))]
+    assert order == ['ff', 'beta', 'ffbeta', 'all']
+
+
+def test_prefix_matcher():
+    prefixes = ['a', 'bc', 'bcd', 'xyz']
+    matcher = PrefixMatcher(prefixes, memo_size=2)
+
+    for value in ('a', 'abc', 'bc', 'bcd-1', 'xyz', 'b', 'xy', 'default',
+                  '', 'ab', 'default'):
+        expected = any(value.startswith(prefix) for prefix in prefixes)
+        assert matcher.matches(value) == expected, value
+    assert len(matcher._memo) <= 2
+
+    assert not PrefixMatcher([]).matches('default')
+    assert PrefixMatcher(['']).matches('default')
+
+
+def test_accumulate():
+    elmts = [1, 2, 3, 4, 5]
+    res = list(accumulate([1, 2, 3, 4, 5]))
+    assert res == [1, 3, 6, 10, 15]
+
+    elmts = []
+    res = list(accumulate(elmts))
+    assert res == []
+
+
+def test_cohort_weights():
+    index = TerritoryIndex('fr', 'fr', {}, {
+        'one': _test(30),
+        'two': _test(50),
+        'three': _test(40),
+    }, 3600)
+    one, two, three = (index.tests[name] for name in ('one', 'two', 'three'))
+
+    assert cohort_weights((one,)) == ([30], 70)
+    assert cohort_weights((one, two)) == ([30, 50], 20)
+    # rates above 100 are cut
+    assert cohort_weights((one, two, three)) == ([30, 50, 20], 0)
+    assert cohort_weights(()) == ([], 100)
+
+
+def test_alias_table():
+    table = AliasTable('abcd', [1, 2, 0, 97])
+    draws = [i / 1000. for i in range(1000)]
+    counts = Counter(table.pick(lambda: draw) for draw in draws)
+    assert counts == {'a': 10, 'b': 20, 'd': 970}, counts
+
+    assert AliasTable('a', [100]).pick() == 'a'
+
+
+def test_samplers_are_cached():
+    index = TerritoryIndex('fr', 'fr', {}, {'one': _test(30)}, 3600,
+                           max_samplers=1)
+    tests = tuple(index.tests.values())
+    sampler = index.sampler(tests)
+    assert index.sampler(tests) is sampler
+    assert index.sampler(()) is not sampler
+    assert len(index._samplers) == 1
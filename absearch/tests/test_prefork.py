@@ -0,0 +1,169 @@
+import array
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import pytest
+
+
+here = os.path.dirname(__file__)
+root = os.path.abspath(os.path.join(here, '..', '..'))
+datadir = os.path.join(root, 'data')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def children(pid):
+    path = '/proc/%d/task/%d/children' % (pid, pid)
+    with open(path) as f:
+        return set(int(child) for child in f.read().split())
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if condition():
+                return True
+        except OSError:
+            pass
+        time.sleep(.1)
+    return False
+
+
+def get(port, path):
+    with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+        sock.sendall(('GET %s HTTP/1.1\r\nConnection: close\r\n\r\n' %
+                      path).encode('latin-1'))
+        data = b''
+        for chunk in iter(lambda: sock.recv(4096), b''):
+            data += chunk
+    return json.loads(data.split(b'\r\n\r\n', 1)[1].decode('utf8'))
+
+
+def start(testdir, port, counter='memory'):
+    shutil.copytree(datadir, os.path.join(testdir, 'data'))
+    with open(os.path.join(here, 'absearch.ini')) as f:
+        ini = f.read().replace('port = 7654', 'port = %d' % port)
+    ini = ini.replace('[absearch]', '[absearch]\nworkers = 2')
+    ini = ini.replace('counter = memory', 'counter = %s' % counter)
+    if counter == 'shared':
+        counters = os.path.join(testdir, 'counters')
+        ini += '\n[counter]\npath = %s\n' % counters
+    with open(os.path.join(testdir, 'absearch.ini'), 'w') as f:
+        f.write(ini)
+
+    return subprocess.Popen(
+        [sys.executable, '-c',
+         'from absearch.prefork import main; main(["absearch.ini"])'],
+        cwd=testdir, env=dict(os.environ, PYTHONPATH=root))
+
+
+def change_config(testdir, change):
+    confpath = os.path.join(testdir, 'data', 'config.json')
+    with open(confpath) as f:
+        config = json.load(f)
+    change(config)
+    with open(confpath, 'w') as f:
+        json.dump(config, f)
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'),
+                    reason='needs /proc')
+def test_prefork():
+    testdir = tempfile.mkdtemp()
+    port = free_port()
+    try:
+        arbiter = start(testdir, port)
+        try:
+            path = '/1/firefox/39/beta/xx/xx/default/default'
+            assert wait_for(lambda: get(port, path))
+            assert get(port, path) == {'interval': 31536000}
+            workers = children(arbiter.pid)
+            assert len(workers) == 2
+
+            # a dead worker is replaced
+            os.kill(workers.pop(), signal.SIGKILL)
+            assert wait_for(lambda: len(children(arbiter.pid) -
+                                        workers) == 1)
+
+            # a new config is served by new workers
+            workers = children(arbiter.pid)
+            change_config(testdir,
+                          lambda config: config.update(defaultInterval=10))
+            arbiter.send_signal(signal.SIGHUP)
+            assert wait_for(lambda: get(port, path) == {'interval': 10})
+            assert wait_for(lambda: not children(arbiter.pid) & workers)
+            assert len(children(arbiter.pid)) == 2
+        finally:
+            arbiter.send_signal(signal.SIGTERM)
+            assert arbiter.wait(15) == 0
+    finally:
+        shutil.rmtree(testdir)
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'),
+                    reason='needs /proc')
+def test_prefork_shared_counters():
+    testdir = tempfile.mkdtemp()
+    port = free_port()
+    path = '/1/firefox/39/beta/de-DE/DE/default/default'
+    served = []
+    stopped = threading.Event()
+
+    def load():
+        while not stopped.is_set():
+            try:
+                get(port, path)
+            except (OSError, ValueError):
+                continue
+            served.append(path)
+
+    try:
+        arbiter = start(testdir, port, counter='shared')
+        try:
+            assert wait_for(lambda: get(port, path))
+            served.append(path)
+            workers = children(arbiter.pid)
+            loader = threading.Thread(target=load)
+            loader.start()
+            try:
+                # new cohorts are counted in a new file, while the old
+                # workers keep counting in the old one
+                def change(config):
+                    locale = config['locales']['de-DE']
+                    locale['AT'] = locale['DE']
+                change_config(testdir, change)
+                arbiter.send_signal(signal.SIGHUP)
+                assert wait_for(lambda: not children(arbiter.pid) &
+                                workers)
+                time.sleep(.5)
+            finally:
+                stopped.set()
+                loader.join()
+        finally:
+            arbiter.send_signal(signal.SIGTERM)
+            assert arbiter.wait(15) == 0
+
+        # nothing the old workers counted was lost
+        files = [name for name in os.listdir(testdir)
+                 if name.startswith('counters.')]
+        assert len(files) == 1
+        with open(os.path.join(testdir, files[0]), 'rb') as f:
+            data = f.read()
+        length = (len(data) - 16) // 16
+        counted = sum(array.array('q', data[16:16 + length * 8]))
+        assert counted >= len(served)
+    finally:
+        shutil.rmtree(testdir)
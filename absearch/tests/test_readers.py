@@ -0,0 +1,36 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from absearch.readers import FileReader
+
+
+def test_file_reader():
+    testdir = tempfile.mkdtemp()
+    path = os.path.join(testdir, 'config.json')
+    try:
+        with open(path, 'w') as f:
+            f.write('{"v": 1}')
+
+        reader = FileReader(path, chunk_size=3)
+        data, md5 = reader()
+        assert data == {'v': 1}
+        assert md5 == hashlib.md5(b'{"v": 1}').hexdigest()
+        assert reader.md5() == md5
+        assert not reader.changed(md5)
+
+        # touching the file without changing it
+        os.utime(path, ns=(1, 1))
+        assert not reader.changed(md5)
+
+        with open(path, 'w') as f:
+            f.write(json.dumps({'v': 2}))
+        assert reader.changed(md5)
+
+        # a missing file is a change, the next read will fail
+        os.remove(path)
+        assert reader.changed(md5)
+    finally:
+        shutil.rmtree(testdir)
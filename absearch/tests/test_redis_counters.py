@@ -0,0 +1,123 @@
+from absearch.redis_counters import RedisCohortCounters
+from absearch.tests.support import FakeRedis
+
+
+KEYS = [('en-US', 'US', 'abc'), ('en-US', 'US', 'def')]
+
+
+def _counters(redis, **kw):
+    counter = RedisCohortCounters(port=redis.port, flush_interval=0, **kw)
+    counter.set_slots(KEYS)
+    return counter
+
+
+def test_write_behind():
+    redis = FakeRedis()
+    try:
+        counter = _counters(redis)
+        for i in range(10):
+            counter.incr('en-US', 'US', 'abc')
+        counter.decr('en-US', 'US', 'abc')
+        counter.incr('en-US', 'US', 'def')
+        assert counter.get('en-US', 'US', 'abc') == 9
+        assert redis.data == {}
+
+        del redis.commands[:]
+        counter.flush()
+        # one INCRBY per cohort
+        assert sorted(redis.commands) == [
+            ['INCRBY', 'absearch:en-US:US:abc', '9'],
+            ['INCRBY', 'absearch:en-US:US:def', '1']]
+        assert redis.data == {'absearch:en-US:US:abc': 9,
+                              'absearch:en-US:US:def': 1}
+        counter.close()
+    finally:
+        redis.stop()
+
+
+def test_fleet():
+    redis = FakeRedis()
+    now = [0]
+    try:
+        one = _counters(redis)
+        two = _counters(redis, clock=lambda: now[0])
+        events = []
+
+        def listener(*args):
+            events.append(args)
+
+        two.set_capacities({('en-US', 'US', 'abc'): 3}, listener)
+        two.flush()
+
+        for i in range(3):
+            one.incr('en-US', 'US', 'abc')
+        one.flush()
+        two.flush()
+        assert two.get('en-US', 'US', 'abc') == 0
+
+        # the capped cohort is read again once stale
+        now[0] += 5
+        two.flush()
+        assert two.get('en-US', 'US', 'abc') == 3
+        assert events == [('en-US', 'US', 'abc', True)]
+
+        # a new instance gets the values of the fleet on its first
+        # flush, without waiting for Redis when it's laid out
+        del redis.commands[:]
+        three = _counters(redis)
+        assert redis.commands == []
+        assert three.get('en-US', 'US', 'abc') == 0
+        three.flush()
+        assert three.get('en-US', 'US', 'abc') == 3
+
+        for counter in one, two, three:
+            counter.close()
+    finally:
+        redis.stop()
+
+
+def test_unreachable():
+    redis = FakeRedis()
+    port = redis.port
+    counter = _counters(redis)
+    redis.stop()
+
+    counter.incr('en-US', 'US', 'abc')
+    counter.incr('en-US', 'US', 'abc')
+    counter.flush()
+    assert not counter.connected
+    assert counter.get('en-US', 'US', 'abc') == 2
+
+    redis = FakeRedis(port)
+    try:
+        counter.incr('en-US', 'US', 'abc')
+        counter.flush()
+        assert counter.connected
+        assert redis.data == {'absearch:en-US:US:abc': 3}
+        counter.close()
+    finally:
+        redis.stop()
+
+
+def test_error_replies():
+    redis = FakeRedis()
+    try:
+        counter = _counters(redis)
+        counter.flush()
+        counter.incr('en-US', 'US', 'abc')
+        counter.incr('en-US', 'US', 'abc')
+
+        # the deltas Redis refused are sent again
+        redis.failing.add('INCRBY')
+        counter.flush()
+        assert redis.data == {}
+        assert counter.get('en-US', 'US', 'abc') == 2
+
+        redis.failing.clear()
+        counter.incr('en-US', 'US', 'abc')
+        counter.flush()
+        assert redis.data == {'absearch:en-US:US:abc': 3}
+        assert counter.get('en-US', 'US', 'abc') == 3
+        counter.close()
+    finally:
+        redis.stop()
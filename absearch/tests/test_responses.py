@@ -0,0 +1,68 @@
+import gzip
+
+from absearch import responses
+from absearch.responses import (ENCODINGS, accepted_encodings,
+                                build_response)
+
+
+def big_response():
+    engines = ['Engine%d' % i for i in range(50)]
+    return build_response({'settings': {'visibleDefaultEngines': engines}},
+                          3600, etag_seed='big')
+
+
+def test_accepted_encodings():
+    assert accepted_encodings(None) == ()
+    assert accepted_encodings('identity') == ()
+    assert accepted_encodings('gzip, deflate') == ('gzip',)
+    assert accepted_encodings('GZIP;q=0.5') == ('gzip',)
+    assert accepted_encodings('gzip;q=0') == ()
+    assert accepted_encodings('*') == ENCODINGS
+    assert accepted_encodings('*, gzip;q=0') == tuple(
+        encoding for encoding in ENCODINGS if encoding != 'gzip')
+
+    # by quality, then in our order
+    assert accepted_encodings('gzip;q=1, br;q=0.5, foo')[0] == 'gzip'
+    assert accepted_encodings('gzip;q=0.5, *;q=0.8')[-1] == 'gzip'
+    assert accepted_encodings('gzip, br') == ENCODINGS
+
+
+def test_variants():
+    res = big_response()
+    assert res.variant() == (None, res.body, res.etag)
+
+    encoding, body, etag = res.variant('gzip, deflate')
+    assert encoding == 'gzip'
+    assert gzip.decompress(body) == res.body
+    assert etag != res.etag
+    # built once
+    assert res.variant('gzip')[1] is body
+
+    sizes = res.sizes()
+    assert sizes['identity'] == len(res.body)
+    assert sizes['gzip'] == len(body) < len(res.body)
+
+
+def test_no_bigger_variant():
+    # compressing a tiny body makes it bigger
+    res = build_response({}, 3600, etag_seed='small')
+    assert res.variants == {}
+    assert res.variant('gzip, br') == (None, res.body, res.etag)
+    assert res.sizes()['gzip'] == len(res.body)
+
+
+def test_no_instance_dict():
+    res = big_response()
+    assert not hasattr(res, '__dict__')
+    assert not hasattr(res['settings'], '__dict__')
+
+
+def test_accepted_encodings_quality(monkeypatch):
+    monkeypatch.setattr(responses, 'ENCODINGS', ('br', 'gzip'))
+    accepted_encodings.cache_clear()
+    try:
+        assert accepted_encodings('gzip;q=1, br;q=0.5') == ('gzip', 'br')
+        assert accepted_encodings('gzip, br') == ('br', 'gzip')
+        assert accepted_encodings('br;q=0.2, *;q=0.5') == ('gzip', 'br')
+    finally:
+        accepted_encodings.cache_clear()
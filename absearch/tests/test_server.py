@@ -2,7 +2,9 @@ import os
 from collections import defaultdict
 import json
 
-from absearch import __version__
+from webtest import TestApp
+
+from absearch import __version__, server
 from absearch.tests.support import get_app
 
 
@@ -268,6 +270,11 @@ def test_hb():
     assert 'schema_md5' in res.json, res.json
     assert 'config_md5' in res.json, res.json
 
+    # the counters are not touched
+    counters = server.app.settings._counters
+    assert counters.get('en-us', 'us', 'default') == 0
+    assert counters.get('en-US', 'US', 'default') == 0
+
 
 def test_root():
     app = get_app()
@@ -329,3 +336,82 @@ def test_string_max_version():
     res = app.get(path)
 
     assert res.json['settings'] == {'searchDefault': 'Yahoo'}
+
+
+def test_etag():
+    app = get_app()
+
+    path = '/1/firefox/39/beta/en-US/US/default/default'
+    res = app.get(path)
+    etag = res.headers['ETag']
+    assert res.content_type == 'application/json'
+
+    # asking again with the ETag sends back a 304 and no body
+    res = app.get(path, headers={'If-None-Match': etag}, status=304)
+    assert res.body == b''
+    assert res.headers['ETag'] == etag
+
+    res = app.get(path, headers={'If-None-Match': 'W/%s, "x"' % etag},
+                  status=304)
+
+    # another cohort has another ETag
+    path = '/1/firefox/39/beta/fr-FR/fr/default/default/fooBaz'
+    res = app.get(path, headers={'If-None-Match': etag})
+    assert res.status_code == 200
+    assert res.headers['ETag'] != etag
+    assert res.json['cohort'] == 'fooBaz'
+
+
+def test_stats():
+    app = get_app()
+    res = app.get('/__stats__')
+    assert 'config.validate' in res.json['timers']
+    assert res.json['invalid'] == []
+
+
+def test_fast_router():
+    get_app()
+    app = TestApp(server.wsgi_app)
+
+    path = '/1/firefox/39/beta/en-US/US/default/default'
+    res = app.get(path)
+    assert res.json['settings'] == {'searchDefault': 'Yahoo'}
+    assert res.content_type == 'application/json'
+    assert res.headers['Cache-Control'] == 'max-age=300'
+    assert res.headers['X-Frame-Options'] == 'DENY'
+    # the same answer as the Bottle app
+    bottle_res = TestApp(server.app).get(path)
+    assert res.body == bottle_res.body
+    assert res.headers['ETag'] == bottle_res.headers['ETag']
+
+    app.get(path, headers={'If-None-Match': res.headers['ETag']},
+            status=304)
+    res = app.get('/1/firefox/39/beta/fr-FR/fr/default/default/fooBaz')
+    assert res.json['cohort'] == 'fooBaz'
+    assert app.get('/__lbheartbeat__').json == {}
+    assert app.head(path).body == b''
+
+    # the other requests go to the Bottle app
+    assert list(app.get('/').json.keys()) == ['description']
+    assert 'config_md5' in app.get('/__heartbeat__').json
+    app.get('/1/firefox/39/beta', status=404)
+    app.post(path, status=405)
+
+
+def test_accept_encoding():
+    app = get_app()
+    path = '/1/firefox/39/beta/en-US/US/default/default'
+    res = app.get(path, headers={'Accept-Encoding': 'gzip'})
+    assert res.headers['Vary'] == 'Accept-Encoding'
+
+    # sent compressed when it's smaller
+    expected = server.app.settings.get(
+        'firefox', '39', 'beta', 'en-US', 'US', 'default', 'default')
+    encoding, body, etag = expected.variant('gzip')
+    assert res.headers.get('Content-Encoding') == encoding
+    assert res.headers['ETag'] == etag
+
+    res = app.get('/__stats__')
+    sizes = res.json['sizes']['en-us']
+    assert sizes['identity'] > 0
+    assert sizes['gzip'] > 0
@@ -1,12 +1,19 @@
+import copy
 import hashlib
 import os
 import shutil
 import tempfile
 import json
+import threading
 import time
 
-from absearch.settings import SearchSettings, accumulate
+import pytest
+from jsonschema.exceptions import ValidationError
+
+from absearch.settings import SearchSettings
 from absearch.exceptions import ReadError
+from absearch.index import parse_version
+from absearch.readers import FileReader
 
 
 def test_max_age():
@@ -42,7 +49,7 @@ def _test_max_age(testdir):
             )
 
     settings = SearchSettings(config_reader, schema_reader, max_age=0.1)
-    assert settings._default_interval == 31536000
+    assert settings._snapshot.default_interval == 31536000
 
     time.sleep(.1)
 
@@ -59,17 +66,7 @@ def _test_max_age(testdir):
     except KeyError:
         pass
 
-    assert settings._default_interval == -1
-
-
-def test_accumulate():
-    elmts = [1, 2, 3, 4, 5]
-    res = list(accumulate([1, 2, 3, 4, 5]))
-    assert res == [1, 3, 6, 10, 15]
-
-    elmts = []
-    res = list(accumulate(elmts))
-    assert res == []
+    assert settings._snapshot.default_interval == -1
 
 
 def test_no_schema_validator():
@@ -131,15 +128,522 @@ def test_immutable_locales():
     finally:
         shutil.rmtree(testdir)
 
-    # the data sent by _get_cohort or _pick_cohort should be a copy
-    res, __ = settings._get_cohort('fr-fr', 'fr', 'default')
-    res['bah'] = 1
-    res, __ = settings._get_cohort('fr-fr', 'fr', 'default')
-    assert 'bah' not in res
-
-    res = settings._pick_cohort('fr-fr', 'fr', 'firefox', 42, 'release')
-    setting = res['settings']
-    setting['bah'] = 1
-    res = settings._pick_cohort('fr-fr', 'fr', 'firefox', 42, 'release')
-    setting = res['settings']
-    assert 'bah' not in setting
+    # the data sent by _get_cohort or _pick_cohort is shared and read-only
+    index = settings._snapshot.locales['fr-fr', 'fr']
+    res = settings._get_cohort(index, 'default')
+    assert res is settings._get_cohort(index, 'default')
+    with pytest.raises(TypeError):
+        res['bah'] = 1
+
+    res = settings._pick_cohort(index, 'firefox', 42, 'release')
+    with pytest.raises(TypeError):
+        res['settings']['bah'] = 1
+    res = settings._pick_cohort(index, 'firefox', 42, 'release')
+    assert 'bah' not in res['settings']
+
+    # copies can be modified
+    copied = copy.deepcopy(res)
+    copied['settings']['bah'] = 1
+    assert 'bah' not in res['settings']
+
+
+def test_background_reload():
+    datadir = os.path.join(os.path.dirname(__file__), '..', '..', 'data')
+    testdir = tempfile.mkdtemp()
+    confpath = os.path.join(testdir, 'config.json')
+
+    shutil.copyfile(os.path.join(datadir, 'config.json'), confpath)
+    reads = []
+
+    def config_reader():
+        reads.append(time.time())
+        with open(confpath) as f:
+            data = f.read()
+            return (
+                json.loads(data),
+                hashlib.md5(data.encode("utf8")).hexdigest(),
+            )
+
+    settings = SearchSettings(config_reader, max_age=0.05,
+                              background_reload=True)
+    try:
+        first = settings._snapshot
+
+        with open(confpath) as f:
+            data = json.loads(f.read())
+        data['defaultInterval'] = -1
+        with open(confpath, 'w') as f:
+            f.write(json.dumps(data))
+
+        # the snapshot is replaced without any request
+        deadline = time.time() + 5
+        while settings._snapshot is first and time.time() < deadline:
+            time.sleep(.01)
+        assert settings._snapshot.default_interval == -1
+
+        # requests don't reload
+        settings.close()
+        time.sleep(.1)
+        count = len(reads)
+        settings.get('firefox', '45', 'release', 'fr', 'fr',
+                     'default', 'default')
+        assert len(reads) == count
+    finally:
+        settings.close()
+        shutil.rmtree(testdir)
+
+
+def test_unchanged_config_is_not_reindexed():
+    datadir = os.path.join(os.path.dirname(__file__), '..', '..', 'data')
+    testdir = tempfile.mkdtemp()
+    confpath = os.path.join(testdir, 'config.json')
+    shutil.copyfile(os.path.join(datadir, 'config.json'), confpath)
+
+    try:
+        reader = FileReader(confpath)
+        settings = SearchSettings(reader)
+        snapshot = settings._snapshot
+
+        assert not settings.load()
+        os.utime(confpath, ns=(1, 1))
+        assert not settings.load()
+        assert settings._snapshot is snapshot
+
+        with open(confpath) as f:
+            data = json.loads(f.read())
+        data['defaultInterval'] = -1
+        with open(confpath, 'w') as f:
+            f.write(json.dumps(data))
+
+        assert settings.load()
+        assert settings._snapshot.default_interval == -1
+    finally:
+        shutil.rmtree(testdir)
+
+
+def test_validator_is_cached():
+    datadir = os.path.join(os.path.dirname(__file__), '..', '..', 'data')
+    config_reader = FileReader(os.path.join(datadir, 'config.json'))
+    schema_reader = FileReader(os.path.join(datadir, 'config.schema.json'))
+
+    settings = SearchSettings(config_reader, schema_reader)
+    validator = settings._validator
+    assert validator is not None
+
+    # forcing a new validation
+    config, md5 = config_reader()
+    schema, schema_md5 = schema_reader()
+    settings._validate(config, schema, schema_md5)
+    assert settings._validator is validator
+
+    timer = settings.metrics.snapshot()['timers']['config.validate']
+    assert timer['count'] == 2
+
+    # errors are the ones jsonschema.validate() raises
+    config['locales']['fr-FR']['FR']['default']['settings'][
+        'searchDefault'] = 'Altavista'
+    with pytest.raises(ValidationError):
+        settings._validate(config, schema, schema_md5)
+
+    # a new schema gets a new validator
+    settings._validate(config, {}, 'other')
+    assert settings._validator is not validator
+
+
+def test_start_time_activation():
+    datadir = os.path.join(os.path.dirname(__file__), '..', '..', 'data')
+    config_reader = FileReader(os.path.join(datadir, 'config.json'))
+
+    # fr-BE/BE has foo23542 at 100% starting at 2567824567
+    start = 2567824567
+    now = [start - 10]
+    settings = SearchSettings(config_reader, clock=lambda: now[0])
+    assert settings._snapshot.next_activation == start
+
+    def get(cohort=None):
+        return settings.get('firefox', '45', 'release', 'fr-BE', 'BE',
+                            'default', 'default', cohort)
+
+    assert 'cohort' not in get('foo23542')
+    now[0] = start
+    assert get().get('cohort') != 'foo23542'
+    assert 'cohort' not in get('foo23542')
+
+    now[0] = start + 1
+    assert get()['cohort'] == 'foo23542'
+    assert get('foo23542')['cohort'] == 'foo23542'
+    assert settings._snapshot.next_activation == float('inf')
+
+
+def test_saturated_cohorts():
+    datadir = os.path.join(os.path.dirname(__file__), '..', '..', 'data')
+    settings = SearchSettings(FileReader(os.path.join(datadir,
+                                                      'config.json')))
+    index = settings._snapshot.locales['fr-fr', 'fr']
+
+    # fooBaz is at 100% with a maxSize of 3
+    for i in range(3):
+        res = settings.get('firefox', '39', 'beta', 'fr-FR', 'fr',
+                           'default', 'default')
+        assert res['cohort'] == 'fooBaz'
+
+    assert settings.saturated_cohorts() == [('fr-fr', 'fr', 'fooBaz')]
+    assert index.candidates('firefox', 'beta', parse_version('39')) == ()
+    res = settings.get('firefox', '39', 'beta', 'fr-FR', 'fr',
+                       'default', 'default')
+    assert 'cohort' not in res
+
+    # the cohort can still be asked for explicitly
+    res = settings.get('firefox', '39', 'beta', 'fr-FR', 'fr',
+                       'default', 'default', 'fooBaz')
+    assert res['cohort'] == 'fooBaz'
+
+    # a new snapshot knows which cohorts are full
+    settings._snapshot = None
+    settings.load()
+    assert settings.saturated_cohorts() == [('fr-fr', 'fr', 'fooBaz')]
+
+    settings._counters.decr('fr-fr', 'fr', 'fooBaz')
+    assert settings.saturated_cohorts() == []
+
+
+def test_counter_backends():
+    datadir = os.path.join(os.path.dirname(__file__), '..', '..', 'data')
+    reader = FileReader(os.path.join(datadir, 'config.json'))
+
+    with pytest.raises(ValueError):
+        SearchSettings(reader, counter='nope')
+
+    testdir = tempfile.mkdtemp()
+    try:
+        settings = SearchSettings(
+            reader, counter='shared',
+            counter_options={'path': os.path.join(testdir, 'counters')})
+        settings.get('firefox', '39', 'beta', 'fr-FR', 'fr', 'default',
+                     'default')
+        assert settings._counters.get('fr-fr', 'fr', 'fooBaz') == 1
+        slot = settings._counters.slot('fr-fr', 'fr', 'fooBaz')
+        assert slot == settings._snapshot.slots.index(
+            ('fr-fr', 'fr', 'fooBaz'))
+    finally:
+        shutil.rmtree(testdir)
+
+
+def test_windowed_max_size():
+    datadir = os.path.join(os.path.dirname(__file__), '..', '..', 'data')
+    with open(os.path.join(datadir, 'config.json')) as f:
+        config = json.load(f)
+    filters = config['locales']['fr-FR']['FR']['tests']['fooBaz'][
+        'filters']
+    filters['maxSizeWindow'] = 60
+
+    now = [3600.]
+    settings = SearchSettings(lambda: (config, 'md5'), clock=lambda: now[0])
+
+    def get():
+        return settings.get('firefox', '39', 'beta', 'fr-FR', 'fr',
+                            'default', 'default')
+
+    # fooBaz is at 100% with a maxSize of 3 per hour
+    for i in range(3):
+        assert get()['cohort'] == 'fooBaz'
+    assert 'cohort' not in get()
+    assert settings.saturated_cohorts() == [('fr-fr', 'fr', 'fooBaz')]
+
+    # an hour later, it's open again
+    now[0] += 3600
+    assert get()['cohort'] == 'fooBaz'
+    assert settings.saturated_cohorts() == []
+
+
+def test_evaluate():
+    datadir = os.path.join(os.path.dirname(__file__), '..', '..', 'data')
+    settings = SearchSettings(FileReader(os.path.join(datadir,
+                                                      'config.json')))
+    request = ('firefox', '39', 'beta', 'fr-FR', 'fr', 'default', 'default')
+
+    # fooBaz is at 100% with a maxSize of 3, and is never filled
+    for i in range(5):
+        assert settings.evaluate(*request)['cohort'] == 'fooBaz'
+    assert settings._counters.get('fr-fr', 'fr', 'fooBaz') == 0
+    assert settings.evaluate(*request, cohort='fooBaz')['cohort'] == 'fooBaz'
+    assert settings.saturated_cohorts() == []
+
+    explanation = settings.explain(*request)
+    assert explanation['reason'] == 'picked'
+    assert explanation['response']['cohort'] == 'fooBaz'
+    assert explanation['candidates'] == {'fooBaz': 100}
+    assert explanation['default'] == 0
+
+    # nightly is not one of fooBaz's channels
+    explanation = settings.explain('firefox', '39', 'nightly', 'fr-FR', 'fr',
+                                   'default', 'default')
+    assert explanation['tests'] == {'fooBaz': 'excluded by channel'}
+    assert explanation['candidates'] == {}
+    assert explanation['default'] == 100
+
+    explanation = settings.explain('firefox', '38', 'beta', 'fr-FR', 'fr',
+                                   'default', 'default')
+    assert explanation['tests'] == {'fooBaz': 'excluded by version'}
+
+    explanation = settings.explain(*request, cohort='nope')
+    assert explanation['reason'] == 'inactive cohort'
+
+    explanation = settings.explain('firefox', '39', 'beta', 'xx', 'xx',
+                                   'default', 'default')
+    assert explanation['reason'] == 'unknown locale'
+    assert settings._counters.get('fr-fr', 'fr', 'fooBaz') == 0
+
+
+def test_single_flight_reload():
+    datadir = os.path.join(os.path.dirname(__file__), '..', '..', 'data')
+    reader = FileReader(os.path.join(datadir, 'config.json'))
+    reading = threading.Event()
+    resume = threading.Event()
+    reads = []
+
+    def config_reader():
+        reads.append(1)
+        if len(reads) > 1:
+            reading.set()
+            resume.wait(5)
+        return reader()
+
+    now = [0]
+    settings = SearchSettings(config_reader, max_age=10,
+                              clock=lambda: now[0])
+    snapshot = settings._snapshot
+
+    def get():
+        return settings.get('firefox', '45', 'release', 'fr', 'fr',
+                            'default', 'default')
+
+    # the first thread seeing an old config reloads it
+    now[0] = 11
+    reloader = threading.Thread(target=get)
+    reloader.start()
+    assert reading.wait(5)
+
+    # the others don't wait for it
+    for i in range(3):
+        get()
+    assert settings.metrics.get('config.reload.coalesced') == 3
+    assert settings._snapshot is snapshot
+
+    resume.set()
+    reloader.join()
+    assert len(reads) == 2
+    get()
+    assert len(reads) == 2
+    assert settings.metrics.snapshot()['timers']['config.reload'][
+        'count'] == 2
+
+
+def test_incremental_reload():
+    datadir = os.path.join(os.path.dirname(__file__), '..', '..', 'data')
+    with open(os.path.join(datadir, 'config.json')) as f:
+        config = json.load(f)
+    version = ['1']
+    settings = SearchSettings(lambda: (copy.deepcopy(config), version[0]))
+    first = settings._snapshot
+    layout = settings._counters._layout
+
+    def get(locale, territory):
+        return settings.get('firefox', '39', 'beta', locale, territory,
+                            'default', 'default')
+
+    etag = get('cs', 'CZ').etag
+    for i in range(3):
+        get('fr-FR', 'FR')
+    assert settings.saturated_cohorts() == [('fr-fr', 'fr', 'fooBaz')]
+
+    # one territory changes
+    config['locales']['cs']['CZ']['default']['settings'][
+        'searchDefault'] = 'Bing'
+    version[0] = '2'
+    assert settings.load()
+    second = settings._snapshot
+    assert second.rebuilt == [('cs', 'cz')]
+    assert settings.metrics.get('config.rebuilt_territories') == len(
+        first.locales) + 1
+
+    # the others are reused, with their state
+    for key, index in second.locales.items():
+        if key == ('cs', 'cz'):
+            assert index is not first.locales[key]
+        else:
+            assert index is first.locales[key]
+    assert second.excluded is first.excluded
+    assert settings._counters._layout is layout
+    assert settings.saturated_cohorts() == [('fr-fr', 'fr', 'fooBaz')]
+    assert 'cohort' not in get('fr-FR', 'FR')
+
+    assert get('cs', 'CZ')['settings']['searchDefault'] == 'Bing'
+    assert get('cs', 'CZ').etag != etag
+
+    # a new interval changes every response
+    config['defaultInterval'] = 10
+    version[0] = '3'
+    settings.load()
+    assert len(settings._snapshot.rebuilt) == len(first.locales)
+
+
+def test_lazy_compilation():
+    datadir = os.path.join(os.path.dirname(__file__), '..', '..', 'data')
+    with open(os.path.join(datadir, 'config.json')) as f:
+        config = json.load(f)
+    config['locales']['cs-CZ']['CZ']['default']['settings'][
+        'searchDefault'] = 'Altavista'
+    schema_reader = FileReader(os.path.join(datadir, 'config.schema.json'))
+
+    # an invalid locale fails the whole config when compiled eagerly
+    with pytest.raises(ValidationError):
+        SearchSettings(lambda: (config, 'md5'), schema_reader)
+
+    settings = SearchSettings(lambda: (config, 'md5'), schema_reader,
+                              lazy=True, warm_locales=['de-DE'])
+    settings._warmer.join()
+    snapshot = settings._snapshot
+    assert sorted(snapshot.locales) == [('de-de', 'de'),
+                                        ('de-de', 'default')]
+
+    # the counters know every cohort before it's compiled
+    for i in range(3):
+        settings._counters.incr('fr-fr', 'fr', 'fooBaz')
+    assert settings.saturated_cohorts() == [('fr-fr', 'fr', 'fooBaz')]
+
+    res = settings.get('firefox', '39', 'beta', 'fr-FR', 'FR', 'default',
+                       'default')
+    assert 'cohort' not in res
+    assert snapshot.locales['fr-fr', 'fr'].saturated == set(['fooBaz'])
+    assert ('en-us', 'us') not in snapshot.locales
+
+    # the invalid locale is served like an unknown one
+    res = settings.get('firefox', '39', 'beta', 'cs-CZ', 'CZ', 'default',
+                       'default')
+    assert res is snapshot.interval_response
+    assert snapshot.invalid == ['cs-cz']
+
+
+def test_lazy_invalid_reload():
+    datadir = os.path.join(os.path.dirname(__file__), '..', '..', 'data')
+    with open(os.path.join(datadir, 'config.json')) as f:
+        config = json.load(f)
+    schema_reader = FileReader(os.path.join(datadir, 'config.schema.json'))
+    loaded = [(config, 'md5')]
+    settings = SearchSettings(lambda: loaded[-1], schema_reader, lazy=True)
+
+    def get(locale, territory):
+        return settings.get('firefox', '39', 'beta', locale, territory,
+                            'default', 'default')
+
+    def invalid(locale, territory):
+        broken = copy.deepcopy(loaded[-1][0])
+        broken['locales'][locale][territory]['default']['settings'][
+            'searchDefault'] = 'Altavista'
+        # a cohort that would be picked, were it valid
+        broken['locales'][locale][territory]['tests'] = {}
+        return broken
+
+    assert get('fr-FR', 'FR')['cohort'] == 'fooBaz'
+    loaded.append((invalid('fr-FR', 'FR'), 'md5-2'))
+    settings.load()
+
+    # the previous settings are kept
+    assert get('fr-FR', 'FR')['cohort'] == 'fooBaz'
+    assert settings.invalid_locales() == ['fr-fr']
+
+    # cs-CZ was not compiled before it became invalid
+    loaded.append((invalid('cs-CZ', 'CZ'), 'md5-3'))
+    settings.load()
+    assert get('cs-CZ', 'CZ')['settings']['searchDefault'] != 'Altavista'
+    assert get('fr-FR', 'FR')['cohort'] == 'fooBaz'
+    assert settings.invalid_locales() == ['cs-cz', 'fr-fr']
+
+    # the kept cohorts keep their counters and capacities
+    assert settings._counters.get('fr-fr', 'fr', 'fooBaz') == 3
+    assert ('fr-fr', 'fr', 'fooBaz') in settings.saturated_cohorts()
+    assert 'cohort' not in get('fr-FR', 'FR')
+
+
+def test_lazy_unreadable_cohorts():
+    datadir = os.path.join(os.path.dirname(__file__), '..', '..', 'data')
+    with open(os.path.join(datadir, 'config.json')) as f:
+        config = json.load(f)
+    schema_reader = FileReader(os.path.join(datadir, 'config.schema.json'))
+
+    def get(locale, territory):
+        return settings.get('firefox', '39', 'beta', locale, territory,
+                            'default', 'default')
+
+    # a test without filters does not fail the load
+    broken = copy.deepcopy(config)
+    del broken['locales']['fr-FR']['FR']['tests']['fooBaz']['filters']
+    settings = SearchSettings(lambda: (broken, 'md5'), schema_reader,
+                              lazy=True)
+    assert get('fr-FR', 'FR') is settings._snapshot.interval_response
+    assert get('en-US', 'US')['settings'] == {'searchDefault': 'Yahoo'}
+    assert settings.invalid_locales() == ['fr-fr']
+    settings.close()
+
+    loaded = [(config, 'md5')]
+    settings = SearchSettings(lambda: loaded[-1], schema_reader, lazy=True)
+    assert get('fr-FR', 'FR')['cohort'] == 'fooBaz'
+
+    # nor a maxSize that's not a number, on reload
+    broken = copy.deepcopy(config)
+    broken['locales']['fr-FR']['FR']['tests']['fooBaz']['filters'][
+        'maxSize'] = 'many'
+    loaded.append((broken, 'md5-2'))
+    assert settings.load()
+    assert settings.config_md5 == 'md5-2'
+
+    # the previous settings of the locale are kept, with their capacity
+    assert get('fr-FR', 'FR')['cohort'] == 'fooBaz'
+    assert settings.invalid_locales() == ['fr-fr']
+    assert settings._counters._capacities[
+        'fr-fr', 'fr', 'fooBaz'] == 3
+    settings.close()
+
+    # unvalidated, it fails the load, and the previous config is kept
+    loaded = [(config, 'md5')]
+    settings = SearchSettings(lambda: loaded[-1])
+    loaded.append((broken, 'md5-2'))
+    with pytest.raises(ValueError):
+        settings.load()
+    assert settings.config_md5 == 'md5'
+    assert settings._counters._capacities[
+        'fr-fr', 'fr', 'fooBaz'] == 3
+    settings.close()
+
+
+def test_cohort_cache():
+    datadir = os.path.join(os.path.dirname(__file__), '..', '..', 'data')
+    config_reader = FileReader(os.path.join(datadir, 'config.json'))
+
+    # fr-BE/BE has foo23542 at 100% starting at 2567824567
+    start = 2567824567
+    now = [start - 10]
+    settings = SearchSettings(config_reader, clock=lambda: now[0])
+    metrics = settings.metrics
+
+    def get():
+        return settings.get('firefox', '45', 'release', 'fr-BE', 'BE',
+                            'default', 'default', 'foo23542')
+
+    first = get()
+    assert 'cohort' not in first
+    assert get() is first
+    assert metrics.get('cohort_cache.misses') == 1
+    assert metrics.get('cohort_cache.hits') == 1
+
+    # the cache is dropped when tests start
+    now[0] = start + 1
+    assert get()['cohort'] == 'foo23542'
+    assert metrics.get('cohort_cache.misses') == 2
+
+    # and when the config is reloaded
+    settings._snapshot = None
+    settings.load()
+    assert get()['cohort'] == 'foo23542'
+    assert metrics.get('cohort_cache.misses') == 3
@@ -0,0 +1,88 @@
+"""Measures the cohort counters under thread contention.
+
+Compares an unsynchronized defaultdict, a single global lock and the
+lock-striped MemoryCohortCounters, and reports the lost updates.
+
+    python scripts/bench_counters.py --threads 8 --calls 20000
+"""
+import argparse
+import sys
+import threading
+import time
+from collections import defaultdict
+
+from absearch.counters import MemoryCohortCounters
+
+
+class UnsafeCounters(object):
+
+    def __init__(self):
+        self._counters = defaultdict(int)
+
+    def incr(self, locale, territory, cohort):
+        self._counters[':'.join((locale, territory, cohort))] += 1
+
+    def get(self, locale, territory, cohort):
+        return self._counters[':'.join((locale, territory, cohort))]
+
+
+class GlobalLockCounters(UnsafeCounters):
+
+    def __init__(self):
+        super(GlobalLockCounters, self).__init__()
+        self._lock = threading.Lock()
+
+    def incr(self, locale, territory, cohort):
+        with self._lock:
+            super(GlobalLockCounters, self).incr(locale, territory, cohort)
+
+
+def run(counters, threads, calls, cohorts):
+    keys = [('en-US', 'US', 'cohort%d' % i) for i in range(cohorts)]
+    start = threading.Event()
+
+    def worker(offset):
+        start.wait()
+        for i in range(calls):
+            counters.incr(*keys[(i + offset) % cohorts])
+
+    workers = [threading.Thread(target=worker, args=(i,))
+               for i in range(threads)]
+    for thread in workers:
+        thread.start()
+
+    began = time.perf_counter()
+    start.set()
+    for thread in workers:
+        thread.join()
+    duration = time.perf_counter() - began
+
+    lost = threads * calls - sum(counters.get(*key) for key in keys)
+    return duration, lost
+
+
+def main(args=sys.argv[1:]):
+    parser = argparse.ArgumentParser(description='Counters benchmark.')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--calls', type=int, default=20000)
+    parser.add_argument('--cohorts', type=int, default=4)
+    parser.add_argument('--switch-interval', type=float, default=None,
+                        help='sys.setswitchinterval() value')
+    args = parser.parse_args(args=args)
+
+    if args.switch_interval is not None:
+        sys.setswitchinterval(args.switch_interval)
+
+    backends = (('unsafe', UnsafeCounters),
+                ('global lock', GlobalLockCounters),
+                ('striped', MemoryCohortCounters))
+
+    total = args.threads * args.calls
+    for name, factory in backends:
+        duration, lost = run(factory(), args.threads, args.calls,
+                             args.cohorts)
+        print('%-12s %10d incr/s  %6d lost' % (name, total / duration, lost))
+
+
+if __name__ == '__main__':
+    main()
@@ -28,5 +28,7 @@ setup(name='absearch',
       entry_points="""
       [console_scripts]
       absearch-server = absearch.server:main
+      absearch-aioserver = absearch.aioserver:main
+      absearch-prefork = absearch.prefork:main
       absearch-check = absearch.check:main
       """)